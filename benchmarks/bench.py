@@ -0,0 +1,49 @@
+"""Helpers shared by the benchmarks
+
+Each benchmark runs against the Cherryize in this checkout, or the one in
+the directory given with --tree (a git worktree of an earlier commit, say),
+so a change can be measured before and after.
+"""
+
+import os
+import socket
+import sys
+import time
+from optparse import OptionParser
+
+# The checkout the benchmarks are in
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parser(usage=None):
+	parser = OptionParser(usage=usage)
+	parser.add_option('-t', '--tree', dest='tree', default=ROOT,
+		help='Directory holding the cherryize package to benchmark (default: this checkout)')
+	return parser
+
+def use_tree(tree):
+	"""Import cherryize from tree from now on"""
+
+	tree = os.path.abspath(tree)
+
+	if not os.path.isdir(os.path.join(tree, 'cherryize')):
+		sys.exit('No cherryize package in %s' % tree)
+
+	sys.path.insert(0, tree)
+	return tree
+
+def wait_for(port, seconds=10):
+	"""Wait until something is listening on port"""
+
+	end = time.time() + seconds
+
+	while True:
+		try:
+			socket.create_connection(('127.0.0.1', port)).close()
+			return
+		except socket.error:
+			if time.time() > end:
+				raise
+			time.sleep(0.05)
+
+def percentile(ordered, fraction):
+	return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
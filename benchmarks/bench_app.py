@@ -0,0 +1,17 @@
+"""The application reuseport.py serves"""
+
+import os
+import time
+
+class App(object):
+	"""Spins for 2ms, then answers with the worker's PID"""
+
+	def __call__(self, environ, start_response):
+		started = time.time()
+
+		while time.time() - started < 0.002:
+			pass
+
+		body = '%s\n' % os.getpid()
+		start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+		return [body]
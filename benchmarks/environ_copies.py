@@ -0,0 +1,77 @@
+"""dict copies and updates made for each request's environ (user-016)
+
+Counts dict.copy and dict.update calls on the server's threads, for an
+app behind a WSGIPathInfoDispatcher: first many requests on one keep-alive
+connection, then one request on each of many connections.
+
+	python benchmarks/environ_copies.py [--tree DIR]
+"""
+
+import socket
+import threading
+import time
+
+import bench
+
+def hello(environ, start_response):
+	start_response('200 OK', [('Content-Length', '2')])
+	return ['ok']
+
+def main():
+	parser = bench.parser()
+	parser.add_option('-n', '--requests', dest='requests', type='int', default=100)
+	parser.add_option('-p', '--port', dest='port', type='int', default=8085)
+	options, args = parser.parse_args()
+
+	bench.use_tree(options.tree)
+	from cherryize import wsgiserver
+
+	counts = {'copy': 0, 'update': 0}
+
+	def profile(frame, event, arg):
+		if (event == 'c_call' and arg.__name__ in counts
+				and getattr(arg, '__self__', None).__class__ is dict):
+			counts[arg.__name__] += 1
+
+	app = wsgiserver.WSGIPathInfoDispatcher({'/app': hello})
+	server = wsgiserver.CherryPyWSGIServer(('127.0.0.1', options.port), app, numthreads=1, timeout=5)
+	server.park_idle = False
+
+	# Set before the server starts, so only its threads are profiled
+	threading.setprofile(profile)
+
+	t = threading.Thread(target=server.start)
+	t.setDaemon(True)
+	t.start()
+	bench.wait_for(options.port)
+
+	n = options.requests
+
+	for connections, requests in ((1, n), (n, 1)):
+		# Let the server finish with the last connection
+		time.sleep(0.2)
+		counts['copy'] = counts['update'] = 0
+
+		for c in range(connections):
+			s = socket.create_connection(('127.0.0.1', options.port))
+
+			for i in range(requests):
+				close = i == requests - 1 and 'Connection: close\r\n' or ''
+				s.sendall('GET /app/x HTTP/1.1\r\nHost: localhost\r\n%s\r\n' % close)
+				data = ''
+
+				while not data.endswith('ok'):
+					data += s.recv(4096)
+
+			s.close()
+
+		time.sleep(0.2)
+		total = float(connections * requests)
+
+		print '%3d connections x %3d requests: %.2f dict.copy, %.2f dict.update per request' % (
+			connections, requests, counts['copy'] / total, counts['update'] / total)
+
+	server.stop()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,74 @@
+"""How long parsing a request takes (user-008)
+
+Times HTTPRequest.parse_request, and read_headers alone, for a request
+with the 15 headers a browser sends, from an in-memory socket.
+
+	python benchmarks/headers.py [--tree DIR]
+"""
+
+import timeit
+
+import bench
+
+REQUEST = ("GET /some/path?x=1 HTTP/1.1\r\n"
+	"Host: example.com\r\n"
+	"User-Agent: Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/118.0\r\n"
+	"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+	"Accept-Language: en-GB,en;q=0.5\r\n"
+	"Accept-Encoding: gzip, deflate, br\r\n"
+	"Connection: keep-alive\r\n"
+	"Cookie: session=abcdef0123456789; theme=dark; tracking=xyz\r\n"
+	"Upgrade-Insecure-Requests: 1\r\n"
+	"Sec-Fetch-Dest: document\r\n"
+	"Sec-Fetch-Mode: navigate\r\n"
+	"Sec-Fetch-Site: none\r\n"
+	"Sec-Fetch-User: ?1\r\n"
+	"Cache-Control: max-age=0\r\n"
+	"If-None-Match: \"abc123\"\r\n"
+	"DNT: 1\r\n"
+	"\r\n")
+
+class Socket(object):
+	"""Gives REQUEST to recv (or recv_into)"""
+
+	def __init__(self):
+		self.data = REQUEST
+
+	def recv(self, size):
+		data, self.data = self.data[:size], self.data[size:]
+		return data
+
+	def recv_into(self, buf, size):
+		data = self.recv(size)
+		buf[:len(data)] = data
+		return len(data)
+
+def parse_request(wsgiserver):
+	rfile = wsgiserver.SizeCheckWrapper(wsgiserver.CP_fileobject(Socket(), 'rb', -1), 0)
+	req = wsgiserver.HTTPRequest(None, {'wsgi.input': rfile, 'ACTUAL_SERVER_PROTOCOL': 'HTTP/1.1'}, None)
+	req.max_request_header_size = 10000
+	req.parse_request()
+
+	assert req.ready and len([k for k in req.environ if k.startswith('HTTP_')]) == 15
+
+def read_headers(wsgiserver):
+	rfile = wsgiserver.SizeCheckWrapper(wsgiserver.CP_fileobject(Socket(), 'rb', -1), 10000)
+	req = wsgiserver.HTTPRequest(None, {'wsgi.input': rfile}, None)
+	rfile.readline()
+	req.read_headers()
+
+def main():
+	parser = bench.parser()
+	parser.add_option('-n', '--number', dest='number', type='int', default=20000,
+		help='Requests parsed in each of 3 runs (the best is reported)')
+	options, args = parser.parse_args()
+
+	bench.use_tree(options.tree)
+	from cherryize import wsgiserver
+
+	for test in (parse_request, read_headers):
+		seconds = min(timeit.repeat(lambda: test(wsgiserver), number=options.number, repeat=3))
+		print '%-14s %.1fus' % (test.__name__, seconds / options.number * 1000000)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,133 @@
+"""Prefork with one shared listening socket against SO_REUSEPORT (user-002)
+
+Starts a server of --workers processes running an app which spins for 2ms
+and answers with its PID, and makes non-keep-alive requests to it from
+--clients threads. Run it with and without --reuse-port; it reports the
+requests a second, the latency percentiles and how the requests were
+spread over the workers.
+
+	python benchmarks/reuseport.py [--tree DIR] [--reuse-port]
+"""
+
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import bench
+
+CONFIG = """app: bench_app.App
+paths: [%(benchmarks)s]
+server_port: %(port)d
+server_daemonize: false
+server_run_dir: %(run_dir)s
+server_workers: %(workers)d
+server_reuse_port: %(reuse_port)s
+server_request_queue_size: %(backlog)d
+log: %(run_dir)s/server.log
+pid_file: %(run_dir)s/server.pid
+"""
+
+def main():
+	parser = bench.parser()
+	parser.add_option('-r', '--reuse-port', dest='reuse_port', action='store_true', default=False)
+	parser.add_option('-w', '--workers', dest='workers', type='int', default=4)
+	parser.add_option('-c', '--clients', dest='clients', type='int', default=32)
+	parser.add_option('-n', '--requests', dest='requests', type='int', default=4000)
+	parser.add_option('-b', '--backlog', dest='backlog', type='int', default=128,
+		help='SERVER_REQUEST_QUEUE_SIZE - with SO_REUSEPORT each worker has its own')
+	parser.add_option('-p', '--port', dest='port', type='int', default=8099)
+	options, args = parser.parse_args()
+
+	tree = bench.use_tree(options.tree)
+	run_dir = tempfile.mkdtemp(prefix='cherryize-bench-')
+
+	try:
+		conf = os.path.join(run_dir, 'server.yaml')
+
+		f = open(conf, 'w')
+		f.write(CONFIG % {
+			'benchmarks': os.path.dirname(os.path.abspath(__file__)),
+			'port': options.port,
+			'run_dir': run_dir,
+			'workers': options.workers,
+			'reuse_port': options.reuse_port and 'true' or 'false',
+			'backlog': options.backlog,
+		})
+		f.close()
+
+		# In a session of its own, so the workers can be killed along with it
+		server = subprocess.Popen([sys.executable, '-c',
+			'import sys; sys.path.insert(0, %r); from cherryize.server import main; main()' % tree,
+			'--conf', conf, 'start'], preexec_fn=os.setsid)
+
+		try:
+			bench.wait_for(options.port)
+			# Give every worker time to start listening
+			time.sleep(1)
+			run(options)
+		finally:
+			os.killpg(server.pid, signal.SIGKILL)
+			server.wait()
+	finally:
+		shutil.rmtree(run_dir)
+
+def run(options):
+	latencies = []
+	workers = {}
+	lock = threading.Lock()
+
+	def client(requests):
+		for i in xrange(requests):
+			started = time.time()
+			s = socket.create_connection(('127.0.0.1', options.port))
+			s.sendall('GET / HTTP/1.0\r\n\r\n')
+			data = ''
+
+			while True:
+				received = s.recv(4096)
+
+				if not received:
+					break
+
+				data += received
+
+			s.close()
+			elapsed = time.time() - started
+			pid = data.split('\r\n\r\n', 1)[-1].strip()
+
+			lock.acquire()
+			try:
+				latencies.append(elapsed)
+				workers[pid] = workers.get(pid, 0) + 1
+			finally:
+				lock.release()
+
+	threads = [threading.Thread(target=client, args=(options.requests // options.clients,))
+		for i in range(options.clients)]
+
+	started = time.time()
+
+	for t in threads:
+		t.start()
+
+	for t in threads:
+		t.join()
+
+	elapsed = time.time() - started
+	latencies.sort()
+
+	print '%s: %.0f requests/s  p50 %.1fms  p99 %.1fms  per worker %s' % (
+		options.reuse_port and 'SO_REUSEPORT' or 'shared socket',
+		len(latencies) / elapsed,
+		bench.percentile(latencies, 0.5) * 1000,
+		bench.percentile(latencies, 0.99) * 1000,
+		' '.join([str(n) for n in sorted(workers.values())]))
+
+if __name__ == '__main__':
+	main()
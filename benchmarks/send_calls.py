@@ -0,0 +1,84 @@
+"""send() calls and requests a second for small responses (user-010)
+
+Serves a 48 byte JSON body with a Content-Length, chunked from a list and
+chunked from a generator, and makes keep-alive requests for each, one
+after another, counting the calls to CP_fileobject.send.
+
+	python benchmarks/send_calls.py [--tree DIR] [--requests N]
+"""
+
+import socket
+import threading
+import time
+
+import bench
+
+BODY = '{"id": 1, "name": "example", "tags": ["a", "b"]}'
+
+def app(environ, start_response):
+	path = environ['PATH_INFO']
+
+	if path == '/length':
+		start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(BODY)))])
+		return [BODY]
+
+	start_response('200 OK', [('Content-Type', 'application/json')])
+
+	if path == '/chunked':
+		return [BODY]
+
+	def generate():
+		yield BODY
+
+	return generate()
+
+def main():
+	parser = bench.parser()
+	parser.add_option('-n', '--requests', dest='requests', type='int', default=2000,
+		help='Requests made for each kind of response')
+	parser.add_option('-p', '--port', dest='port', type='int', default=8097)
+	options, args = parser.parse_args()
+
+	bench.use_tree(options.tree)
+	from cherryize import wsgiserver
+
+	calls = [0]
+	send = wsgiserver.CP_fileobject.send
+
+	def counted_send(self, data):
+		calls[0] += 1
+		return send(self, data)
+
+	wsgiserver.CP_fileobject.send = counted_send
+
+	server = wsgiserver.CherryPyWSGIServer(('127.0.0.1', options.port), app, numthreads=2, timeout=5)
+	server.park_idle = False
+
+	t = threading.Thread(target=server.start)
+	t.setDaemon(True)
+	t.start()
+	bench.wait_for(options.port)
+
+	for path in ('/length', '/chunked', '/generator'):
+		s = socket.create_connection(('127.0.0.1', options.port))
+		request = 'GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % path
+		calls[0] = 0
+		started = time.time()
+
+		for i in xrange(options.requests):
+			s.sendall(request)
+			data = ''
+
+			while not (data.endswith(BODY) or data.endswith('0\r\n\r\n')):
+				data += s.recv(4096)
+
+		elapsed = time.time() - started
+		s.close()
+
+		print '%-10s %.2f sends/request %6.0f requests/s' % (path, calls[0] / float(options.requests),
+			options.requests / elapsed)
+
+	server.stop()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,281 @@
+"""Access log for Cherryize
+
+Worker threads only append a tuple for each request to a deque (which
+needs no lock), and a background thread formats what has built up and
+writes it in one go, every so often - so logging a request costs the
+worker next to nothing, and the workers never wait on the file or on
+each other.
+"""
+
+import collections
+import fcntl
+import os
+import random
+import re
+import sys
+import threading
+import time
+from json.encoder import encode_basestring_ascii
+
+__all__ = ('AccessLog', 'FORMATS')
+
+# Bytes escaped (as \xNN) in the quoted fields of the combined format
+UNSAFE = re.compile(r'[\x00-\x1f\x7f-\xff"\\]')
+
+class AccessLog(object):
+	"""An access log written to path, in format ('combined' or 'json')
+
+	sample is the fraction of requests logged. Once the file reaches
+	max_bytes (unless that's 0) it is renamed path.1 (path.1 becomes path.2
+	and so on, up to backups) and a new one started. reopen() has the file
+	opened again, after it has been moved away by something else. Records
+	are written every flush_interval seconds; if more than max_pending
+	build up in between, the rest are dropped (and counted).
+
+	start() the writer thread in each process which serves requests, and
+	close() to write what's left.
+	"""
+
+	def __init__(self, path, format='combined', sample=1.0, max_bytes=0, backups=5,
+			flush_interval=0.5, max_pending=100000):
+		if format not in FORMATS:
+			raise ValueError('Unknown access log format %r' % format)
+
+		self.path = path
+		self.format = FORMATS[format]
+		self.sample = sample
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.flush_interval = flush_interval
+		self.max_pending = max_pending
+
+		self.pending = collections.deque()
+		self.dropped = 0
+		self.reported = 0
+
+		self.fd = None
+		self.thread = None
+		self.reopening = False
+
+		# Only the writer thread (or close) writes
+		self.lock = threading.Lock()
+
+		# The last time formatted, by the second
+		self.second = None
+		self.timestamp = None
+
+	def request(self, req, seconds, sent):
+		"""Called by the server on the worker thread: keep what we need
+		about the request, to be formatted later"""
+
+		if self.sample < 1 and random.random() >= self.sample:
+			return
+
+		if len(self.pending) >= self.max_pending:
+			self.dropped += 1
+			return
+
+		environ = req.environ
+
+		self.pending.append((
+			req.started,
+			environ.get('REMOTE_ADDR'),
+			environ.get('REMOTE_USER'),
+			req.request_line,
+			req.status,
+			sent,
+			environ.get('HTTP_REFERER'),
+			environ.get('HTTP_USER_AGENT'),
+			seconds,
+		))
+
+	def error_log(self, msg):
+		sys.stderr.write(msg + '\n')
+
+	def start(self):
+		"""Open the file and start writing, in this process"""
+
+		self.open()
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.setName('Cherryize access log')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def run(self):
+		while True:
+			time.sleep(self.flush_interval)
+
+			try:
+				self.flush()
+			except Exception, e:
+				self.error_log('Unable to write access log %s - %s' % (self.path, e))
+
+	def close(self):
+		"""Write what's pending (the writer thread may be stopped by the
+		process exiting now)"""
+
+		if self.fd is not None:
+			self.flush()
+
+	def reopen(self):
+		"""Open the file again before the next write (safe from a signal
+		handler)"""
+
+		self.reopening = True
+
+	def flush(self):
+		self.lock.acquire()
+		try:
+			pending = self.pending
+			records = []
+
+			try:
+				while True:
+					records.append(pending.popleft())
+			except IndexError:
+				pass
+
+			if self.reopening or self.moved():
+				self.reopening = False
+				self.open()
+
+			if records:
+				self.write(''.join([self.format(self, record) for record in records]))
+
+			if self.dropped != self.reported:
+				self.error_log('Access log %s dropped %d records (%d pending at once)'
+					% (self.path, self.dropped - self.reported, self.max_pending))
+				self.reported = self.dropped
+
+			if self.max_bytes and os.fstat(self.fd).st_size >= self.max_bytes:
+				self.rotate()
+		finally:
+			self.lock.release()
+
+	def open(self):
+		fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+		if self.fd is not None:
+			os.close(self.fd)
+
+		self.fd = fd
+
+	def moved(self):
+		"""Has the file been renamed or deleted since we opened it (rotated
+		by another process, say)?"""
+
+		try:
+			return os.stat(self.path).st_ino != os.fstat(self.fd).st_ino
+		except OSError:
+			return True
+
+	def write(self, data):
+		# Appending, so the processes sharing the file don't overwrite
+		# each other; a batch is one write unless it's very large
+		while data:
+			written = os.write(self.fd, data)
+			data = data[written:]
+
+	def rotate(self):
+		"""Move the full file aside and start another"""
+
+		# The worker processes share the file, only one of them rotates it
+		fcntl.lockf(self.fd, fcntl.LOCK_EX)
+		try:
+			if not self.moved():
+				for n in range(self.backups - 1, 0, -1):
+					name = '%s.%d' % (self.path, n)
+
+					if os.path.exists(name):
+						os.rename(name, '%s.%d' % (self.path, n + 1))
+
+				if self.backups:
+					os.rename(self.path, self.path + '.1')
+				else:
+					os.remove(self.path)
+		finally:
+			fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+		self.open()
+
+	def local_time(self, t, format):
+		"""t formatted, remembered for the rest of the second - format's %z
+		is replaced by the UTC offset first, Python 2's strftime always gives
+		+0000 for it"""
+
+		second = int(t)
+
+		if second != self.second:
+			local = time.localtime(second)
+			self.timestamp = time.strftime(format.replace('%z', utc_offset(local)), local)
+			self.second = second
+
+		return self.timestamp
+
+def format_combined(log, record):
+	"""The NCSA combined log format (the bytes include the headers)"""
+
+	started, addr, user, request_line, status, sent, referer, agent, seconds = record
+
+	return '%s - %s [%s] "%s" %s %s "%s" "%s"\n' % (
+		addr or '-',
+		user and escape(user) or '-',
+		log.local_time(started, '%d/%b/%Y:%H:%M:%S %z'),
+		escape(request_line or '-'),
+		status[:3] or '-',
+		sent or '-',
+		escape(referer or '-'),
+		escape(agent or '-'),
+	)
+
+def format_json(log, record):
+	"""One JSON object a line (put together by hand, json.dumps of a dict
+	is several times slower)"""
+
+	started, addr, user, request_line, status, sent, referer, agent, seconds = record
+
+	return ('{"time":"%s","remote_addr":%s,"remote_user":%s,"request":%s,"status":%s,'
+		'"bytes_sent":%d,"referer":%s,"user_agent":%s,"duration":%.6f}\n') % (
+		log.local_time(started, '%Y-%m-%dT%H:%M:%S%z'),
+		json_string(addr),
+		json_string(user),
+		json_string(request_line),
+		status[:3].isdigit() and status[:3] or 'null',
+		sent,
+		json_string(referer),
+		json_string(agent),
+		seconds,
+	)
+
+FORMATS = {
+	'combined': format_combined,
+	'json': format_json,
+}
+
+def utc_offset(local):
+	"""The UTC offset (as +HHMM) in effect at a time.localtime()"""
+
+	if local.tm_isdst > 0 and time.daylight:
+		offset = -time.altzone
+	else:
+		offset = -time.timezone
+
+	sign = offset < 0 and '-' or '+'
+	hours, minutes = divmod(abs(offset) // 60, 60)
+
+	return '%s%02d%02d' % (sign, hours, minutes)
+
+def escape(value):
+	if UNSAFE.search(value) is None:
+		return value
+
+	return UNSAFE.sub(lambda match: '\\x%02X' % ord(match.group()), value)
+
+def json_string(value):
+	"""value as JSON - the client sent bytes, which may not be UTF-8"""
+
+	if value is None:
+		return 'null'
+
+	return encode_basestring_ascii(value.decode('utf-8', 'replace'))
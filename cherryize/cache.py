@@ -0,0 +1,646 @@
+"""Response caching for Cherryize
+
+Keeps whole responses from the WSGI application so repeated requests for a
+cacheable resource are answered without calling it. Freshness comes from the
+response's Cache-Control header (or the CACHE_TTL setting).
+"""
+
+import fcntl
+import marshal
+import mmap
+import struct
+import tempfile
+import threading
+import time
+from hashlib import md5
+
+__all__ = ('ResponseCache', 'MemoryStore', 'SharedMemoryStore')
+
+# Statuses we store - the ones a cache may keep when told how long for
+CACHEABLE_STATUS = frozenset(['200', '203', '300', '301', '404', '410'])
+
+# Rough per-entry overhead (key, tuples, list links) counted against the cap
+ENTRY_OVERHEAD = 256
+
+# Shared store slot header: sequence, key hash, expires, last used, data length
+SLOT_HEADER = struct.Struct('=IQddI')
+
+# Slots a key may live in - the least recently used of them is replaced
+SLOT_WAYS = 8
+
+# Attempts at reading a slot that is being written before calling it a miss
+READ_RETRIES = 3
+
+class MemoryStore(object):
+	"""An in-process LRU store, capped at max_size bytes
+
+	Values are kept as they are given. Entries are dropped least recently
+	used first once the cap is reached, or as soon as they are found to be
+	past their expiry time.
+	"""
+
+	def __init__(self, max_size=64 * 1024 * 1024):
+		self.max_size = max_size
+		self.size = 0
+		self.evictions = 0
+
+		self.lock = threading.Lock()
+
+		# key -> [prev, next, key, value, size, expires], a circular list
+		# with the most recently used entry just after the root
+		self.entries = {}
+		self.root = root = []
+		root[:] = [root, root, None, None, 0, 0]
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key):
+		"""Return the value stored under key, or None"""
+
+		self.lock.acquire()
+		try:
+			link = self.entries.get(key)
+
+			if link is None:
+				return None
+
+			if link[5] <= time.time():
+				self.unlink(link)
+				return None
+
+			# Move to the front
+			prev, next = link[0], link[1]
+			prev[1] = next
+			next[0] = prev
+
+			root = self.root
+			first = root[1]
+			link[0], link[1] = root, first
+			root[1] = first[0] = link
+
+			return link[3]
+		finally:
+			self.lock.release()
+
+	def set(self, key, value, size, expires):
+		"""Store value (taking about size bytes) under key until expires"""
+
+		size += ENTRY_OVERHEAD
+
+		if size > self.max_size:
+			return
+
+		self.lock.acquire()
+		try:
+			old = self.entries.get(key)
+
+			if old is not None:
+				self.unlink(old)
+
+			root = self.root
+			first = root[1]
+			link = [root, first, key, value, size, expires]
+			root[1] = first[0] = link
+
+			self.entries[key] = link
+			self.size += size
+
+			while self.size > self.max_size:
+				self.unlink(root[0])
+				self.evictions += 1
+		finally:
+			self.lock.release()
+
+	def delete(self, key):
+		self.lock.acquire()
+		try:
+			link = self.entries.get(key)
+
+			if link is not None:
+				self.unlink(link)
+		finally:
+			self.lock.release()
+
+	def unlink(self, link):
+		"""Remove an entry (called with the lock held)"""
+
+		prev, next = link[0], link[1]
+		prev[1] = next
+		next[0] = prev
+
+		del self.entries[link[2]]
+		self.size -= link[4]
+
+class SharedMemoryStore(object):
+	"""A store shared by every process forked after it is created
+
+	The entries live in an anonymous shared memory map, divided into slots of
+	slot_size bytes (so values must marshal to less than that). Each key may
+	go in one of SLOT_WAYS slots; an expired or the least recently used one
+	is replaced when they are all taken.
+
+	Readers take no locks. Each slot has a sequence number which is odd while
+	it is being written, and a read is only trusted if the number was even
+	and unchanged across it. Writers lock the group of slots with lockf,
+	so they exclude other processes, as well as a lock for threads in this
+	one.
+	"""
+
+	def __init__(self, max_size=64 * 1024 * 1024, slot_size=32 * 1024):
+		self.slot_size = slot_size
+		self.groups = max(max_size // (slot_size * SLOT_WAYS), 1)
+		self.slots = self.groups * SLOT_WAYS
+		self.evictions = 0
+
+		self.map = mmap.mmap(-1, self.slots * slot_size)
+
+		# Only used for its locks, one byte per group of slots
+		self.lock_file = tempfile.TemporaryFile()
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		now = time.time()
+		count = 0
+
+		for slot in xrange(self.slots):
+			seq, key_hash, expires, used, length = SLOT_HEADER.unpack_from(self.map, slot * self.slot_size)
+
+			if length and expires > now:
+				count += 1
+
+		return count
+
+	@property
+	def size(self):
+		"""Bytes in the live entries"""
+
+		now = time.time()
+		size = 0
+
+		for slot in xrange(self.slots):
+			seq, key_hash, expires, used, length = SLOT_HEADER.unpack_from(self.map, slot * self.slot_size)
+
+			if length and expires > now:
+				size += length
+
+		return size
+
+	def locate(self, key):
+		"""The hash of a key and the group of slots it belongs in"""
+
+		key_hash = struct.unpack('=Q', md5(key).digest()[:8])[0]
+		return key_hash, key_hash % self.groups
+
+	def get(self, key):
+		"""Return the value stored under key, or None"""
+
+		key_hash, group = self.locate(key)
+		mm = self.map
+		now = time.time()
+
+		for slot in xrange(group * SLOT_WAYS, (group + 1) * SLOT_WAYS):
+			offset = slot * self.slot_size
+
+			for attempt in xrange(READ_RETRIES):
+				seq, slot_hash, expires, used, length = SLOT_HEADER.unpack_from(mm, offset)
+
+				if slot_hash != key_hash or not length:
+					break
+
+				if seq & 1:
+					# Being written
+					continue
+
+				start = offset + SLOT_HEADER.size
+				data = mm[start:start + length]
+
+				if SLOT_HEADER.unpack_from(mm, offset)[0] != seq:
+					continue
+
+				if expires <= now:
+					return None
+
+				try:
+					stored_key, value = marshal.loads(data)
+				except (EOFError, ValueError, TypeError):
+					return None
+
+				if stored_key != key:
+					break
+
+				# Only a hint for eviction, so not worth a lock
+				struct.pack_into('=d', mm, offset + 20, now)
+
+				return value
+
+		return None
+
+	def set(self, key, value, size, expires):
+		"""Store value under key until expires (size is ignored, the slot
+		size is what counts)"""
+
+		try:
+			data = marshal.dumps((key, value))
+		except ValueError:
+			return
+
+		if len(data) > self.slot_size - SLOT_HEADER.size:
+			return
+
+		key_hash, group = self.locate(key)
+
+		self.lock_group(group)
+		try:
+			slot, evicted = self.choose(group, key_hash)
+			self.write(slot, key_hash, expires, data)
+
+			if evicted:
+				self.evictions += 1
+		finally:
+			self.unlock_group(group)
+
+	def delete(self, key):
+		key_hash, group = self.locate(key)
+
+		self.lock_group(group)
+		try:
+			for slot in xrange(group * SLOT_WAYS, (group + 1) * SLOT_WAYS):
+				if SLOT_HEADER.unpack_from(self.map, slot * self.slot_size)[1] == key_hash:
+					self.write(slot, 0, 0, '')
+		finally:
+			self.unlock_group(group)
+
+	def choose(self, group, key_hash):
+		"""Pick the slot to write: one already holding the key, a free or
+		expired one, or the least recently used. Returns (slot, evicted)"""
+
+		now = time.time()
+		oldest = None
+
+		for slot in xrange(group * SLOT_WAYS, (group + 1) * SLOT_WAYS):
+			seq, slot_hash, expires, used, length = SLOT_HEADER.unpack_from(self.map, slot * self.slot_size)
+
+			if slot_hash == key_hash:
+				return slot, False
+
+			if not length or expires <= now:
+				return slot, False
+
+			if oldest is None or used < oldest[1]:
+				oldest = (slot, used)
+
+		return oldest[0], True
+
+	def write(self, slot, key_hash, expires, data):
+		"""Write a slot (with the group locked), readers will see either the
+		old or the new contents or know it was changing"""
+
+		mm = self.map
+		offset = slot * self.slot_size
+		seq = SLOT_HEADER.unpack_from(mm, offset)[0]
+
+		# Odd while we write...
+		struct.pack_into('=I', mm, offset, (seq + 1) & 0xffffffff)
+
+		start = offset + SLOT_HEADER.size
+		mm[start:start + len(data)] = data
+
+		SLOT_HEADER.pack_into(mm, offset, (seq + 1) & 0xffffffff, key_hash, expires, time.time(), len(data))
+
+		# ...and even again once we are done
+		struct.pack_into('=I', mm, offset, (seq + 2) & 0xffffffff)
+
+	def lock_group(self, group):
+		self.lock.acquire()
+
+		try:
+			fcntl.lockf(self.lock_file.fileno(), fcntl.LOCK_EX, 1, group)
+		except:
+			self.lock.release()
+			raise
+
+	def unlock_group(self, group):
+		try:
+			fcntl.lockf(self.lock_file.fileno(), fcntl.LOCK_UN, 1, group)
+		finally:
+			self.lock.release()
+
+class ResponseCache(object):
+	"""WSGI middleware answering repeated requests from a store
+
+	Responses are keyed on the method, host, path and query string plus the
+	request headers named in their Vary header. How long one is fresh comes
+	from s-maxage or max-age (default_ttl when it has neither); private,
+	no-store and no-cache responses, and ones setting cookies, are never
+	stored. For stale seconds after that (or the response's own
+	stale-while-revalidate) the old copy is still served while a single
+	background request to the application refreshes it.
+	"""
+
+	def __init__(self, app, store, default_ttl=0, stale=0, max_entry_size=1024 * 1024):
+		self.app = app
+		self.store = store
+		self.default_ttl = default_ttl
+		self.stale = stale
+		self.max_entry_size = max_entry_size
+
+		# Keys being refreshed in the background
+		self.refreshing = set()
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.stale_hits = 0
+		self.misses = 0
+		self.stores = 0
+
+	def __call__(self, environ, start_response):
+		method = environ['REQUEST_METHOD']
+
+		if method not in ('GET', 'HEAD'):
+			return self.app(environ, start_response)
+
+		base = '%s %s%s?%s' % (
+			method,
+			environ.get('HTTP_HOST') or environ.get('SERVER_NAME', ''),
+			environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+			environ.get('QUERY_STRING', '')
+		)
+
+		if 'no-cache' not in environ.get('HTTP_CACHE_CONTROL', ''):
+			vary = self.store.get('vary ' + base)
+
+			if vary is not None:
+				entry = self.store.get(self.key(base, vary, environ))
+
+				if entry is not None:
+					return self.hit(environ, start_response, base, entry)
+
+		self.misses += 1
+
+		return self.fetch(environ, start_response, base)
+
+	def key(self, base, vary, environ):
+		"""The store key for a request, given the headers its response varies on"""
+
+		if not vary:
+			return base
+
+		return '\n'.join([base] + [environ.get(name, '') for name in vary])
+
+	def hit(self, environ, start_response, base, entry):
+		"""Answer from a stored response"""
+
+		status, headers, body, stored, fresh_until = entry
+		now = time.time()
+
+		if now < fresh_until:
+			self.hits += 1
+			cache_status = 'HIT'
+		else:
+			# Stale but still kept, so within stale-while-revalidate
+			self.stale_hits += 1
+			cache_status = 'STALE'
+			self.refresh(environ, base)
+
+		start_response(status, headers + [
+			('Age', str(int(now - stored))),
+			('X-Cache', cache_status),
+		])
+
+		if environ['REQUEST_METHOD'] == 'HEAD':
+			return []
+
+		return [body]
+
+	def refresh(self, environ, base):
+		"""Re-fetch a stale response in a background thread (once per key)"""
+
+		self.lock.acquire()
+		try:
+			if base in self.refreshing:
+				return
+
+			self.refreshing.add(base)
+		finally:
+			self.lock.release()
+
+		environ = environ.copy()
+
+		# The request is a GET or HEAD, there is no body to read
+		environ['wsgi.input'] = EmptyInput()
+
+		t = threading.Thread(target=self.background_fetch, args=(environ, base))
+		t.setDaemon(True)
+		t.start()
+
+	def background_fetch(self, environ, base):
+		def start_response(status, headers, exc_info=None):
+			return lambda data: None
+
+		try:
+			try:
+				body = self.fetch(environ, start_response, base)
+
+				try:
+					for chunk in body:
+						pass
+				finally:
+					if hasattr(body, 'close'):
+						body.close()
+			except Exception:
+				# The stale copy stays until it expires
+				pass
+		finally:
+			self.lock.acquire()
+			self.refreshing.discard(base)
+			self.lock.release()
+
+	def fetch(self, environ, start_response, base):
+		"""Call the application, storing its response if we can"""
+
+		response = {}
+
+		def caching_start_response(status, headers, exc_info=None):
+			write = start_response(status, headers, exc_info)
+			policy = None
+
+			if exc_info is None:
+				policy = self.policy(environ, status, headers)
+
+			if policy is None:
+				response.clear()
+				response['body'] = None
+				return write
+
+			response['policy'] = policy
+			response['status'] = status
+			response['headers'] = headers
+			response['body'] = []
+			response['size'] = 0
+
+			def caching_write(data):
+				self.keep(response, data)
+				write(data)
+
+			return caching_write
+
+		result = self.app(environ, caching_start_response)
+
+		if response and response['body'] is None:
+			# Not cacheable, hand back the application's response untouched
+			return result
+
+		return CachingIterable(self, result, response, base, environ)
+
+	def policy(self, environ, status, headers):
+		"""Return (fresh seconds, stale seconds, vary) for a storable response,
+		otherwise None"""
+
+		if status[:3] not in CACHEABLE_STATUS:
+			return None
+
+		cache_control = ''
+		vary = ()
+
+		for name, value in headers:
+			name = name.lower()
+
+			if name == 'cache-control':
+				cache_control = value.lower()
+			elif name == 'vary':
+				vary = [v.strip() for v in value.split(',') if v.strip()]
+			elif name == 'set-cookie':
+				return None
+
+		directives = {}
+
+		for directive in cache_control.split(','):
+			name, sep, value = directive.strip().partition('=')
+			directives[name] = value.strip('"')
+
+		if 'no-store' in directives or 'private' in directives or 'no-cache' in directives:
+			return None
+
+		if '*' in vary:
+			return None
+
+		# The key doesn't include Authorization, so only responses marked as
+		# shareable are kept for authorised requests (RFC 7234 3.2)
+		if 'HTTP_AUTHORIZATION' in environ and not (
+				'public' in directives or 's-maxage' in directives or 'must-revalidate' in directives):
+			return None
+
+		if 's-maxage' in directives:
+			ttl = directives['s-maxage']
+		elif 'max-age' in directives:
+			ttl = directives['max-age']
+		else:
+			ttl = self.default_ttl
+
+		stale = directives.get('stale-while-revalidate', self.stale)
+
+		try:
+			ttl = int(ttl)
+			stale = int(stale)
+		except ValueError:
+			return None
+
+		if ttl <= 0:
+			return None
+
+		vary = tuple(['HTTP_' + v.upper().replace('-', '_') for v in vary])
+
+		return ttl, max(stale, 0), vary
+
+	def keep(self, response, data):
+		"""Add to the copy of a response being passed through, giving up on
+		it once it passes max_entry_size"""
+
+		if response.get('body') is None:
+			return
+
+		response['size'] += len(data)
+
+		if response['size'] > self.max_entry_size:
+			response['body'] = None
+		else:
+			response['body'].append(data)
+
+	def save(self, response, base, environ):
+		"""Store a complete response"""
+
+		ttl, stale, vary = response['policy']
+		body = ''.join(response['body'])
+		now = time.time()
+
+		# The same Vary for every response to this resource
+		self.store.set('vary ' + base, vary, len(base), now + ttl + stale)
+
+		headers = [(name, value) for name, value in response['headers'] if name.lower() != 'age']
+
+		if environ['REQUEST_METHOD'] == 'GET' and 'content-length' not in [name.lower() for name, value in headers]:
+			# It was streamed, but from here on we know how long it is
+			headers.append(('Content-Length', str(len(body))))
+
+		entry = (response['status'], headers, body, now, now + ttl)
+
+		size = len(body) + sum([len(name) + len(value) for name, value in headers])
+		self.store.set(self.key(base, vary, environ), entry, size, now + ttl + stale)
+
+		self.stores += 1
+
+	def stats(self):
+		"""Counters, for monitoring"""
+
+		return {
+			'hits': self.hits,
+			'stale_hits': self.stale_hits,
+			'misses': self.misses,
+			'stores': self.stores,
+			'evictions': self.store.evictions,
+			'entries': len(self.store),
+			'bytes': self.store.size,
+		}
+
+class CachingIterable(object):
+	"""Passes the application's response through, keeping a copy which is
+	stored once it has all been sent"""
+
+	def __init__(self, cache, result, response, base, environ):
+		self.cache = cache
+		self.result = result
+		self.response = response
+		self.base = base
+		self.environ = environ
+
+	def __iter__(self):
+		# The application may only call start_response once we start iterating
+		keep = self.cache.keep
+		response = self.response
+
+		for data in self.result:
+			keep(response, data)
+			yield data
+
+		if response.get('body') is not None:
+			self.cache.save(response, self.base, self.environ)
+
+	def close(self):
+		if hasattr(self.result, 'close'):
+			self.result.close()
+
+class EmptyInput(object):
+	"""wsgi.input for background refreshes"""
+
+	def read(self, size=-1):
+		return ''
+
+	def readline(self, size=-1):
+		return ''
+
+	def readlines(self, hint=0):
+		return []
+
+	def __iter__(self):
+		return iter([])
@@ -0,0 +1,393 @@
+"""Response compression for Cherryize
+
+Gzips responses for clients which accept it, when they are of a listed
+content type and not too small to bother with.
+"""
+
+import zlib
+
+from cherryize.cache import MemoryStore
+
+__all__ = ('GzipMiddleware', 'accepts_gzip', 'gzip_etag')
+
+# Content types compressed unless the GZIP_TYPES setting says otherwise
+DEFAULT_TYPES = (
+	'text/html',
+	'text/plain',
+	'text/css',
+	'text/xml',
+	'text/javascript',
+	'application/javascript',
+	'application/json',
+	'application/xml',
+)
+
+# Compressed bodies larger than this are not kept in the cache
+CACHE_MAX_ENTRY = 1024 * 1024
+
+# zlib window bits asking for a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Cached bodies never expire, a new ETag is a new key
+NEVER = float('inf')
+
+def accepts_gzip(environ):
+	"""Does the client's Accept-Encoding allow gzip? Codings are matched
+	without regard to case, and '*' stands for gzip unless gzip (or x-gzip)
+	is listed itself"""
+
+	accept = environ.get('HTTP_ACCEPT_ENCODING')
+
+	if not accept:
+		return False
+
+	accept = accept.lower()
+
+	if 'gzip' not in accept and '*' not in accept:
+		return False
+
+	qualities = {}
+
+	for coding in accept.split(','):
+		coding, sep, params = coding.partition(';')
+		qualities.setdefault(coding.strip(), quality(params))
+
+	for coding in ('gzip', 'x-gzip', '*'):
+		if coding in qualities:
+			# Accepted unless its quality is 0
+			return qualities[coding] > 0
+
+	return False
+
+def quality(params):
+	"""The q of an Accept-Encoding entry's parameters - 1 without one, 0 if
+	it can't be read"""
+
+	for param in params.split(';'):
+		name, sep, value = param.partition('=')
+
+		if name.strip() == 'q':
+			try:
+				return float(value)
+			except ValueError:
+				return 0
+
+	return 1
+
+def gzip_etag(etag):
+	"""The ETag of the gzipped version of a response"""
+
+	if etag.endswith('"'):
+		return etag[:-1] + '-gzip"'
+
+	return etag
+
+def strip_gzip_etags(value):
+	"""An If-None-Match or If-Match header with our gzip ETags turned back
+	into the application's own"""
+
+	return value.replace('-gzip"', '"')
+
+class GzipMiddleware(object):
+	"""WSGI middleware gzipping responses
+
+	GET responses are compressed when the client accepts gzip, the status is
+	200, the Content-Type is one of types, there's no Content-Encoding
+	already, Cache-Control doesn't say no-transform and the body is at
+	least min_size bytes (when we can tell). Whole (list) bodies go out
+	with a Content-Length, others are compressed as they are streamed -
+	an empty chunk flushes what has been compressed so far.
+
+	Compressed bodies of responses with a strong ETag are kept, up to
+	cache_size bytes, so the same response isn't compressed twice.
+	"""
+
+	def __init__(self, app, min_size=1024, types=DEFAULT_TYPES, level=6, cache_size=16 * 1024 * 1024):
+		self.app = app
+		self.min_size = min_size
+		self.types = frozenset([t.lower() for t in types])
+		self.level = level
+		self.cache = None
+
+		if cache_size:
+			self.cache = MemoryStore(cache_size)
+
+	def __call__(self, environ, start_response):
+		# The client may be validating a gzipped response, whose ETag the
+		# application doesn't know
+		validating = False
+
+		for name in ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MATCH'):
+			value = environ.get(name)
+
+			if value is not None and '-gzip"' in value:
+				environ[name] = strip_gzip_etags(value)
+				validating = True
+
+		if environ['REQUEST_METHOD'] != 'GET':
+			return self.app(environ, start_response)
+
+		response = GzipResponse(self, environ, start_response)
+		response.validating = validating
+		result = self.app(environ, response.start_response)
+
+		return response.finish(result)
+
+	def compressible(self, status, headers):
+		"""Could this response be compressed? (Whether it will be also
+		depends on the client)"""
+
+		if status[:3] != '200':
+			return False
+
+		content_type = None
+
+		for name, value in headers:
+			name = name.lower()
+
+			if name == 'content-type':
+				content_type = value.split(';', 1)[0].strip().lower()
+			elif name == 'content-encoding':
+				return False
+			elif name == 'content-length':
+				try:
+					if int(value) < self.min_size:
+						return False
+				except ValueError:
+					return False
+			elif name == 'cache-control' and 'no-transform' in value:
+				return False
+
+		return content_type in self.types
+
+	def compressor(self):
+		return zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+
+	def compress(self, data):
+		c = self.compressor()
+		return c.compress(data) + c.flush()
+
+	def cache_key(self, environ, etag):
+		if self.cache is None or not etag or etag.startswith('W/'):
+			return None
+
+		# ETags only need to be unique to a resource, which may be the same
+		# path on another host or with another query string
+		return '%s\n%s%s?%s\n%s' % (environ.get('HTTP_HOST', ''), environ.get('SCRIPT_NAME', ''),
+			environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', ''), etag)
+
+class GzipResponse(object):
+	"""One response passing through the GzipMiddleware
+
+	start_response is held back for compressible responses, until we know
+	whether the body is complete (and how long it is once compressed) or
+	has to be streamed.
+	"""
+
+	def __init__(self, gzip, environ, start_response):
+		self.gzip = gzip
+		self.environ = environ
+		self.server_start_response = start_response
+
+		self.called = False
+		self.status = None
+		self.headers = None
+		self.started = False
+		self.compressing = False
+		self.compressor = None
+		self.cache_key = None
+		self.validating = False
+
+	def start_response(self, status, headers, exc_info=None):
+		self.called = True
+
+		if status[:3] == '304' and self.validating:
+			# Not modified - it's the gzipped version the client has
+			headers = [(name, name.lower() == 'etag' and gzip_etag(value) or value) for name, value in headers]
+
+		if exc_info is not None or not self.gzip.compressible(status, headers):
+			self.compressing = False
+			return self.server_start_response(status, headers, exc_info)
+
+		# The response differs by Accept-Encoding, whoever it's going to
+		headers = self.add_vary(headers)
+
+		if not accepts_gzip(self.environ):
+			self.compressing = False
+			return self.server_start_response(status, headers)
+
+		etag = None
+		gzip_headers = [('Content-Encoding', 'gzip')]
+
+		for name, value in headers:
+			lname = name.lower()
+
+			if lname == 'etag':
+				etag = value
+				gzip_headers.append((name, gzip_etag(value)))
+			elif lname != 'content-length':
+				gzip_headers.append((name, value))
+
+		self.status = status
+		self.headers = headers
+		self.gzip_headers = gzip_headers
+		self.cache_key = self.gzip.cache_key(self.environ, etag)
+		self.compressing = True
+
+		return self.write
+
+	def add_vary(self, headers):
+		for i, (name, value) in enumerate(headers):
+			if name.lower() == 'vary':
+				if 'accept-encoding' in value.lower() or value.strip() == '*':
+					return headers
+
+				headers = list(headers)
+				headers[i] = (name, value + ', Accept-Encoding')
+				return headers
+
+		return list(headers) + [('Vary', 'Accept-Encoding')]
+
+	def start(self, length=None):
+		"""Pass the (compressed) response's headers on to the server"""
+
+		headers = self.gzip_headers
+
+		if length is not None:
+			headers = headers + [('Content-Length', str(length))]
+
+		self.started = True
+		self.server_write = self.server_start_response(self.status, headers)
+
+	def finish(self, result):
+		"""Deal with what the application returned"""
+
+		if not self.compressing:
+			if not self.called and not isinstance(result, (list, tuple)):
+				# start_response may be called once it's iterated
+				return GzipIterable(self, result)
+
+			return result
+
+		if self.started:
+			# The application has used write(), carry on streaming
+			return GzipIterable(self, result)
+
+		cache = self.gzip.cache
+
+		if self.cache_key is not None:
+			data = cache.get(self.cache_key)
+
+			if data is not None:
+				if hasattr(result, 'close'):
+					result.close()
+
+				return self.whole(data)
+
+		if isinstance(result, (list, tuple)):
+			body = ''.join(result)
+
+			if hasattr(result, 'close'):
+				result.close()
+
+			if len(body) < self.gzip.min_size:
+				# Not worth it after all
+				self.compressing = False
+				headers = [(name, value) for name, value in self.headers if name.lower() != 'content-length']
+				self.server_start_response(self.status, headers + [('Content-Length', str(len(body)))])
+				return [body]
+
+			data = self.gzip.compress(body)
+
+			if self.cache_key is not None and len(data) <= CACHE_MAX_ENTRY:
+				cache.set(self.cache_key, data, len(data), NEVER)
+
+			return self.whole(data)
+
+		return GzipIterable(self, result)
+
+	def whole(self, data):
+		self.start(len(data))
+		return [data]
+
+	def compress(self, data, mode=None):
+		"""Compress the next part of a streamed body"""
+
+		if self.compressor is None:
+			self.compressor = self.gzip.compressor()
+			self.kept = []
+			self.kept_size = 0
+
+		out = self.compressor.compress(data)
+
+		if mode is not None:
+			out += self.compressor.flush(mode)
+
+		if out and self.cache_key is not None:
+			self.kept_size += len(out)
+
+			if self.kept_size > CACHE_MAX_ENTRY:
+				self.cache_key = None
+			else:
+				self.kept.append(out)
+
+		return out
+
+	def write(self, data):
+		"""write() for the application, compressing as it goes"""
+
+		if not self.started:
+			self.start()
+
+		out = self.compress(data, zlib.Z_SYNC_FLUSH)
+
+		if out:
+			self.server_write(out)
+
+	def end(self):
+		"""Compress the rest of a streamed body, and keep it if we can"""
+
+		out = self.compress('', zlib.Z_FINISH)
+
+		if self.cache_key is not None:
+			self.gzip.cache.set(self.cache_key, ''.join(self.kept), self.kept_size, NEVER)
+
+		return out
+
+class GzipIterable(object):
+	"""Compresses a streamed response as the server iterates it"""
+
+	def __init__(self, response, result):
+		self.response = response
+		self.result = result
+
+	def __iter__(self):
+		response = self.response
+
+		for data in self.result:
+			if not response.compressing:
+				yield data
+				continue
+
+			if not response.started:
+				response.start()
+
+			if data:
+				out = response.compress(data)
+
+				if out:
+					yield out
+			else:
+				# Asked to flush, so flush the compressor too
+				yield response.compress('', zlib.Z_SYNC_FLUSH)
+				yield ''
+
+		if response.compressing:
+			if not response.started:
+				response.start()
+
+			yield response.end()
+
+	def close(self):
+		if hasattr(self.result, 'close'):
+			self.result.close()
@@ -0,0 +1,142 @@
+"""Mounting several WSGI applications in one server
+
+Requests are routed on their Host header and the segments of their path,
+so the cost of finding the application depends on the depth of the path
+rather than how many applications are mounted.
+"""
+
+__all__ = ('MountDispatcher', 'parse_mount')
+
+class MountNode(object):
+	"""A path segment in the trie, and the application mounted there (if any)"""
+
+	__slots__ = ('children', 'app')
+
+	def __init__(self):
+		self.children = {}
+		self.app = None
+
+def parse_mount(mount):
+	"""Split a mount such as 'example.com/blog' or '/blog' into its host
+	('' for any) and its path segments"""
+
+	if mount.startswith('/'):
+		host, path = '', mount
+	else:
+		host, sep, path = mount.partition('/')
+		host = host.lower()
+
+	return host, [segment for segment in path.split('/') if segment]
+
+class MountDispatcher(object):
+	"""WSGI dispatcher for applications mounted at host and path prefixes
+
+	mounts maps prefixes to applications. A prefix is a path ('/blog'), or
+	a host and a path ('example.com/blog'); a host on its own means its
+	root. The longest matching path for the request's host wins, then the
+	longest for mounts without a host. The matched prefix is moved from
+	PATH_INFO to SCRIPT_NAME in the request's environ.
+	"""
+
+	def __init__(self, mounts):
+		# host -> root of its trie, '' for mounts without a host
+		self.hosts = {}
+
+		try:
+			mounts = mounts.items()
+		except AttributeError:
+			pass
+
+		for mount, app in mounts:
+			host, segments = parse_mount(mount)
+			node = self.hosts.get(host)
+
+			if node is None:
+				node = self.hosts[host] = MountNode()
+
+			for segment in segments:
+				child = node.children.get(segment)
+
+				if child is None:
+					child = node.children[segment] = MountNode()
+
+				node = child
+
+			node.app = app
+
+		self.default = self.hosts.get('')
+
+	def __call__(self, environ, start_response):
+		path = environ['PATH_INFO'] or '/'
+
+		match = None
+		root = self.hosts.get(self.host(environ))
+
+		if root is not None:
+			match = self.find(root, path)
+
+		if match is None and self.default is not None:
+			match = self.find(self.default, path)
+
+		if match is None:
+			start_response('404 Not Found', [
+				('Content-Type', 'text/plain'),
+				('Content-Length', '0'),
+			])
+			return ['']
+
+		app, length = match
+
+		# Each request has its own environ, so change it in place
+		environ['SCRIPT_NAME'] = environ['SCRIPT_NAME'] + path[:length]
+		environ['PATH_INFO'] = path[length:]
+
+		return app(environ, start_response)
+
+	def host(self, environ):
+		"""The request's host name, without any port"""
+
+		host = environ.get('HTTP_HOST')
+
+		if not host:
+			return environ.get('SERVER_NAME', '').lower()
+
+		if host.startswith('['):
+			# An IPv6 address, the port is after the brackets
+			return host[:host.find(']') + 1].lower()
+
+		return host.split(':', 1)[0].lower()
+
+	def find(self, node, path):
+		"""Return (app, length of the matched prefix) for the deepest mount on
+		path below node, or None"""
+
+		app = node.app
+		length = 0
+
+		# Where the segment being looked at starts, just after its slash
+		start = 1
+		end = len(path)
+		find = path.find
+
+		while start <= end:
+			stop = find('/', start)
+
+			if stop == -1:
+				stop = end
+
+			node = node.children.get(path[start:stop])
+
+			if node is None:
+				break
+
+			if node.app is not None:
+				app = node.app
+				length = stop
+
+			start = stop + 1
+
+		if app is None:
+			return None
+
+		return app, length
@@ -0,0 +1,330 @@
+"""Server metrics for Cherryize
+
+Counts requests, bytes and connections, and keeps latency histograms, as
+the server works. Each thread records into its own shard, without locks;
+the shards are only added together when the metrics are read, which gives
+them in the Prometheus text format.
+"""
+
+import math
+import threading
+
+from cherryize.wsgiserver import CherryPyWSGIServer
+
+__all__ = ('Metrics', 'MetricsApp', 'Histogram')
+
+# Histogram buckets per doubling - each is at most 12.5% wide
+SUB_BUCKETS = 8
+
+# The buckets exported per doubling (the recorded ones folded together), and
+# the doublings exported from a microsecond up (to about a minute) - every
+# process exports the same bounds, so they can be added up across processes
+EXPORT_SUB_BUCKETS = 2
+EXPORT_DOUBLINGS = 26
+
+# The content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+class Histogram(object):
+	"""Counts of values (in seconds) in log-linear buckets, in the manner of
+	an HDR histogram: every doubling from a microsecond up is split into
+	SUB_BUCKETS buckets, and only the buckets used take any space"""
+
+	__slots__ = ('buckets', 'count', 'sum')
+
+	def __init__(self):
+		self.buckets = {}
+		self.count = 0
+		self.sum = 0.0
+
+	def record(self, seconds):
+		micro = seconds * 1000000
+
+		if micro < 1:
+			index = 0
+		else:
+			mantissa, exponent = math.frexp(micro)
+			index = exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+
+		buckets = self.buckets
+		buckets[index] = buckets.get(index, 0) + 1
+		self.count += 1
+		self.sum += seconds
+
+	def merge(self, other):
+		for index, count in other.buckets.items():
+			self.buckets[index] = self.buckets.get(index, 0) + count
+
+		self.count += other.count
+		self.sum += other.sum
+
+def export_index(index):
+	"""The exported bucket a histogram bucket is folded into"""
+
+	if not index:
+		# Under a microsecond
+		return 0
+
+	exponent, sub = divmod(index, SUB_BUCKETS)
+	return (exponent - 1) * EXPORT_SUB_BUCKETS + sub * EXPORT_SUB_BUCKETS // SUB_BUCKETS + 1
+
+def export_bound(index):
+	"""The upper bound (in seconds) of an exported bucket"""
+
+	if not index:
+		return 0.000001
+
+	exponent, sub = divmod(index - 1, EXPORT_SUB_BUCKETS)
+	return math.ldexp(0.5 + (sub + 1) / (2.0 * EXPORT_SUB_BUCKETS), exponent + 1) / 1000000
+
+EXPORT_BOUNDS = tuple([export_bound(index) for index in range(EXPORT_DOUBLINGS * EXPORT_SUB_BUCKETS + 1)])
+
+class MetricsShard(object):
+	"""One thread's counts"""
+
+	def __init__(self, thread=None):
+		self.thread = thread
+		self.requests = {}
+		self.latency = {}
+		self.queue_wait = Histogram()
+		self.received = 0
+		self.sent = 0
+		self.accepted = 0
+		self.rejected = 0
+
+	def merge(self, other):
+		for code, count in other.requests.items():
+			self.requests[code] = self.requests.get(code, 0) + count
+
+		for route, histogram in other.latency.items():
+			if route not in self.latency:
+				self.latency[route] = Histogram()
+
+			self.latency[route].merge(histogram)
+
+		self.queue_wait.merge(other.queue_wait)
+		self.received += other.received
+		self.sent += other.sent
+		self.accepted += other.accepted
+		self.rejected += other.rejected
+
+class Metrics(object):
+	"""The metrics of one server process
+
+	Give it to CherryPyWSGIServer.metrics. Request latencies are kept per
+	route: the longest of routes (a list of path prefixes) the request's
+	path starts with, otherwise its SCRIPT_NAME (where a MountDispatcher
+	mounted its application) or '/'.
+	"""
+
+	def __init__(self, routes=()):
+		self.routes = sorted([r.rstrip('/') or '/' for r in routes], key=len, reverse=True)
+		self.server = None
+
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.shards = []
+
+		# What the threads which have exited had counted
+		self.retired = MetricsShard()
+
+	def shard(self):
+		"""The calling thread's shard"""
+
+		try:
+			return self.local.shard
+		except AttributeError:
+			shard = self.local.shard = MetricsShard(threading.currentThread())
+
+			self.lock.acquire()
+			try:
+				self.shards.append(shard)
+			finally:
+				self.lock.release()
+
+			return shard
+
+	def accepted(self):
+		self.shard().accepted += 1
+
+	def rejected(self):
+		self.shard().rejected += 1
+
+	def waited(self, seconds):
+		self.shard().queue_wait.record(seconds)
+
+	def request(self, req, seconds, received, sent):
+		shard = self.shard()
+
+		code = req.status[:3]
+		shard.requests[code] = shard.requests.get(code, 0) + 1
+		shard.received += received
+		shard.sent += sent
+
+		route = self.route(req.environ)
+		histogram = shard.latency.get(route)
+
+		if histogram is None:
+			histogram = shard.latency[route] = Histogram()
+
+		histogram.record(seconds)
+
+	def route(self, environ):
+		script_name = environ.get('SCRIPT_NAME', '')
+
+		if self.routes:
+			path = script_name + environ.get('PATH_INFO', '')
+
+			for route in self.routes:
+				if path.startswith(route) and (len(path) == len(route) or path[len(route)] == '/' or route == '/'):
+					return route
+
+		return script_name or '/'
+
+	def totals(self):
+		"""All the threads' counts added together"""
+
+		total = MetricsShard()
+		total.merge(self.retired)
+
+		self.lock.acquire()
+		try:
+			for shard in self.shards[:]:
+				total.merge(shard)
+
+				if not shard.thread.isAlive():
+					# It won't count any more, so fold it into the retired
+					self.retired.merge(shard)
+					self.shards.remove(shard)
+		finally:
+			self.lock.release()
+
+		return total
+
+	def exposition(self):
+		"""The metrics in the Prometheus text format"""
+
+		total = self.totals()
+		lines = []
+
+		def metric(name, kind, help, samples):
+			lines.append('# HELP %s %s' % (name, help))
+			lines.append('# TYPE %s %s' % (name, kind))
+
+			for labels, value in samples:
+				lines.append('%s%s %s' % (name, labels, format_value(value)))
+
+		metric('cherryize_requests_total', 'counter', 'Requests answered, by status code.',
+			[('{code="%s"}' % code, count) for code, count in sorted(total.requests.items())])
+		metric('cherryize_received_bytes_total', 'counter', 'Bytes received from clients.',
+			[('', total.received)])
+		metric('cherryize_sent_bytes_total', 'counter', 'Bytes sent to clients.',
+			[('', total.sent)])
+		metric('cherryize_connections_accepted_total', 'counter', 'Connections accepted.',
+			[('', total.accepted)])
+		metric('cherryize_connections_rejected_total', 'counter', 'Connections turned away with a 503.',
+			[('', total.rejected)])
+
+		samples = []
+
+		for route, histogram in sorted(total.latency.items()):
+			samples.extend(histogram_samples(histogram, 'route="%s"' % escape(route)))
+
+		metric('cherryize_request_duration_seconds', 'histogram',
+			'Time from the request line arriving to the response being sent, by route.', samples)
+		metric('cherryize_queue_wait_seconds', 'histogram',
+			'Time connections waited for a worker thread.', histogram_samples(total.queue_wait))
+
+		server = self.server
+
+		if server is not None:
+			pool = server.requests
+			size = pool.size
+			idle = pool.idle
+
+			metric('cherryize_queue_depth', 'gauge', 'Connections waiting for a worker thread.',
+				[('', pool.qsize)])
+			metric('cherryize_workers', 'gauge', 'Worker threads, by state.',
+				[('{state="busy"}', max(size - idle, 0)), ('{state="idle"}', idle)])
+
+			if server.poller is not None:
+				metric('cherryize_parked_connections', 'gauge', 'Idle connections waiting for a request.',
+					[('', server.poller.parked)])
+
+		return '\n'.join(lines) + '\n'
+
+	def serve(self, bind_addr, reuse_port=False):
+		"""Serve the metrics (on any path) from a server of their own, in a
+		background thread"""
+
+		server = CherryPyWSGIServer(bind_addr, MetricsApp(None, self), numthreads=1)
+		server.reuse_port = reuse_port
+		server.prepare()
+
+		t = threading.Thread(target=server.serve)
+		t.setName('Cherryize metrics')
+		t.setDaemon(True)
+		t.start()
+
+		return server
+
+class MetricsApp(object):
+	"""WSGI middleware answering requests for path with the metrics (or every
+	request, when there's no app)"""
+
+	def __init__(self, app, metrics, path='/metrics'):
+		self.app = app
+		self.metrics = metrics
+		self.path = path
+
+	def __call__(self, environ, start_response):
+		if self.app is not None and environ.get('PATH_INFO') != self.path:
+			return self.app(environ, start_response)
+
+		body = self.metrics.exposition()
+
+		start_response('200 OK', [
+			('Content-Type', CONTENT_TYPE),
+			('Content-Length', str(len(body))),
+			('Cache-Control', 'no-store'),
+		])
+
+		return [body]
+
+def histogram_samples(histogram, labels=''):
+	"""Cumulative bucket, sum and count samples for a Histogram, with the
+	buckets folded into EXPORT_BOUNDS (values above the last are only in
+	+Inf)"""
+
+	samples = []
+	separator = labels and ',' or ''
+	counts = [0] * len(EXPORT_BOUNDS)
+
+	for index, count in histogram.buckets.items():
+		index = export_index(index)
+
+		if index < len(counts):
+			counts[index] += count
+
+	cumulative = 0
+
+	for bound, count in zip(EXPORT_BOUNDS, counts):
+		cumulative += count
+		samples.append(('_bucket{%s%sle="%s"}' % (labels, separator, format_value(bound)), cumulative))
+
+	samples.append(('_bucket{%s%sle="+Inf"}' % (labels, separator), histogram.count))
+
+	labels = labels and '{%s}' % labels
+	samples.append(('_sum%s' % labels, histogram.sum))
+	samples.append(('_count%s' % labels, histogram.count))
+
+	return samples
+
+def format_value(value):
+	if isinstance(value, float):
+		return repr(float('%.6g' % value))
+
+	return str(value)
+
+def escape(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,178 @@
+"""Sampling profiler for Cherryize
+
+Profiles a running server without restarting it: for a while, a
+background thread looks at what each busy worker thread is doing a number
+of times a second, then writes how often each stack was seen as collapsed
+stacks - the input of flamegraph.pl and speedscope - with the path of the
+request being served at the root of each stack.
+"""
+
+import os
+import sys
+import threading
+import time
+
+__all__ = ('SamplingProfiler',)
+
+class SamplingProfiler(object):
+	"""Samples the stacks of a CherryPyWSGIServer's worker threads
+
+	rate is the samples taken each second and seconds how long a profile
+	lasts. path is where the profile is written, with %(pid)s replaced by
+	the process ID (so each worker process writes its own). Only threads
+	handling a connection are sampled; idle ones are counted, not walked.
+	"""
+
+	def __init__(self, server, path, rate=100, seconds=30):
+		self.server = server
+		self.path = path
+		self.rate = rate
+		self.seconds = seconds
+
+		self.thread = None
+
+	def running(self):
+		return self.thread is not None and self.thread.isAlive()
+
+	def start(self):
+		"""Profile in a background thread, unless a profile is running. Returns
+		the path the profile will be written to, or None"""
+
+		if self.running():
+			return None
+
+		path = self.path % {'pid': os.getpid()}
+
+		self.thread = threading.Thread(target=self.run, args=(path,))
+		self.thread.setName('Cherryize profiler')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+		return path
+
+	def run(self, path):
+		counts = {}
+		codes = {}
+		interval = 1.0 / self.rate
+		started = time.time()
+		end = started + self.seconds
+		next = started
+		samples = 0
+		idle = 0
+
+		while True:
+			now = time.time()
+
+			if now >= end:
+				break
+
+			if now < next:
+				time.sleep(next - now)
+
+			idle += self.sample(counts, codes)
+			samples += 1
+
+			# Keep to the rate, but don't try to catch up samples we missed
+			next = max(next + interval, time.time())
+
+		self.write(path, counts, codes, samples, idle, time.time() - started)
+
+	def sample(self, counts, codes):
+		"""Add the stacks of the busy worker threads to counts (and the code
+		objects of new ones to codes), and return how many threads were idle"""
+
+		frames = sys._current_frames()
+		idle = 0
+
+		for worker in self.server.requests._threads[:]:
+			conn = worker.conn
+
+			if conn is None:
+				idle += 1
+				continue
+
+			frame = frames.get(worker.ident)
+
+			if frame is None:
+				continue
+
+			# Counted by path and the ids of the code objects (which hash
+			# far quicker than the code objects do), labels are made at the end
+			top = frame
+			stack = [self.request_label(conn.req)]
+
+			while frame is not None:
+				stack.append(id(frame.f_code))
+				frame = frame.f_back
+
+			key = tuple(stack)
+			count = counts.get(key)
+
+			if count is None:
+				# A new stack, keep its code objects (so the ids stay theirs)
+				codes[key] = self.codes(top)
+				count = 0
+
+			counts[key] = count + 1
+
+		return idle
+
+	def codes(self, frame):
+		codes = []
+
+		while frame is not None:
+			codes.append(frame.f_code)
+			frame = frame.f_back
+
+		return codes
+
+	def label(self, code):
+		label = '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+		return label.replace(';', ':')
+
+	def request_label(self, req):
+		"""The root of the stack - the path of the request being served"""
+
+		if req is None or req.started is None:
+			return '(reading request)'
+
+		environ = req.environ
+		path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+
+		# Spaces would be taken for the count
+		return (path or '(reading request)').replace(';', '%3B').replace(' ', '%20')
+
+	def write(self, path, counts, codes, samples, idle, elapsed):
+		labels = {}
+		stacks = {}
+
+		for key, count in counts.items():
+			# The root first, then the outermost frame down to the innermost
+			stack = [key[0]]
+
+			for code in reversed(codes[key]):
+				label = labels.get(code)
+
+				if label is None:
+					label = labels[code] = self.label(code)
+
+				stack.append(label)
+
+			# Code objects can share a label (a module reloaded, say)
+			stack = ';'.join(stack)
+			stacks[stack] = stacks.get(stack, 0) + count
+
+		lines = ['%s %d\n' % (stack, count) for stack, count in sorted(stacks.items())]
+
+		try:
+			f = open(path, 'w')
+			try:
+				f.writelines(lines)
+			finally:
+				f.close()
+		except IOError, e:
+			self.server.error_log('Unable to write profile to %s - %s' % (path, e))
+			return
+
+		self.server.error_log('Profile written to %s: %d samples in %.1fs, %d stack samples, '
+			'%d idle thread samples' % (path, samples, elapsed, sum(counts.values()), idle))
@@ -8,15 +8,26 @@ applications such as Django, Pylons etc...
 
 import os
 import os.path
+import errno
+import fcntl
 import logging
 import sys
 import signal
+import socket
 import time
 from optparse import OptionParser
 
 import yaml
 
-from cherryize.wsgiserver import CherryPyWSGIServer
+from cherryize.wsgiserver import CherryPyWSGIServer, SO_REUSEPORT
+from cherryize.static import StaticFiles
+from cherryize.cache import ResponseCache, MemoryStore, SharedMemoryStore
+from cherryize.compress import GzipMiddleware, DEFAULT_TYPES
+from cherryize.dispatch import MountDispatcher
+from cherryize.metrics import Metrics, MetricsApp
+from cherryize.trace import ChromeTrace
+from cherryize.profiler import SamplingProfiler
+from cherryize.accesslog import AccessLog
 from cherryize.utils import import_object, get_uid_gid, switch_uid_gid
 
 __all__ = ('WSGIServer',)
@@ -24,16 +35,59 @@ __version__ = '0.9'
 
 DEFAULTS = {
 	'APP': '',
+	'MOUNTS': {},
 	'SERVER_NAME': 'localhost',
 	'SERVER_THREADS': 10,
+	'SERVER_THREADS_MIN': None,
+	'SERVER_THREADS_MAX': None,
+	'SERVER_WORKERS': 1,
+	'SERVER_REUSE_PORT': False,
 	'SERVER_RUN_DIR': '/tmp',
 	'SERVER_DAEMONIZE': True,
 	'SERVER_USER': 'nobody',
 	'SERVER_GROUP': 'nobody',
 	'SERVER_TIMEOUT': 60,
+	'SERVER_PARK_IDLE': True,
 	'SERVER_IP': '127.0.0.1',
 	'SERVER_PORT': 8080,
 	'SERVER_REQUEST_QUEUE_SIZE': 5,
+	'SERVER_QUEUE_LIMIT': 0,
+	'SERVER_QUEUE_TARGET': 0,
+	'SERVER_QUEUE_INTERVAL': 1,
+	'SERVER_RETRY_AFTER': 5,
+	'SERVER_WRITE_BUFFER': 0,
+	'SERVER_STREAM_CHUNKED': False,
+	'STATIC': {},
+	'STATIC_MAX_AGE': 0,
+	'STATIC_CACHE_SIZE': 16 * 1024 * 1024,
+	'STATIC_STAT_INTERVAL': 1,
+	'CACHE': False,
+	'CACHE_SIZE': 64 * 1024 * 1024,
+	'CACHE_TTL': 0,
+	'CACHE_STALE': 0,
+	'CACHE_MAX_ENTRY': 1024 * 1024,
+	'CACHE_SHARED': False,
+	'CACHE_SLOT_SIZE': 32 * 1024,
+	'GZIP': False,
+	'GZIP_MIN_SIZE': 1024,
+	'GZIP_TYPES': list(DEFAULT_TYPES),
+	'GZIP_LEVEL': 6,
+	'GZIP_CACHE_SIZE': 16 * 1024 * 1024,
+	'METRICS': False,
+	'METRICS_PATH': '',
+	'METRICS_IP': '127.0.0.1',
+	'METRICS_PORT': 0,
+	'METRICS_ROUTES': [],
+	'TRACE_FILE': '',
+	'TRACE_SAMPLE': 0.01,
+	'PROFILE_FILE': 'profile-%(pid)s.txt',
+	'PROFILE_RATE': 100,
+	'PROFILE_SECONDS': 30,
+	'ACCESS_LOG': '',
+	'ACCESS_LOG_FORMAT': 'combined',
+	'ACCESS_LOG_SAMPLE': 1.0,
+	'ACCESS_LOG_MAX_BYTES': 0,
+	'ACCESS_LOG_BACKUPS': 5,
 	'LOG': 'server.log',
 	'LOG_FORMAT': '%(asctime)s %(levelname)s %(message)s',
 	'PID_FILE': 'server.pid',
@@ -45,7 +99,14 @@ DEFAULTS = {
 	'UMASK': 0
 }
 
-VALID_COMMANDS = 'START', 'STOP', 'RESTART'
+VALID_COMMANDS = 'START', 'STOP', 'RESTART', 'PROFILE'
+
+# Seconds a worker must survive before it's respawned without a pause
+WORKER_RESPAWN_DELAY = 1
+
+# Environment variables used to hand the listening socket to a new server
+LISTEN_FD_ENV = 'CHERRYIZE_LISTEN_FD'
+PARENT_PID_ENV = 'CHERRYIZE_PARENT_PID'
 
 class WSGIServer(object):
 	"""A Basic WSGI Server"""
@@ -62,13 +123,16 @@ class WSGIServer(object):
 		
 		config = dict([(k.upper(), v) for k, v in config.items()])
 		
+		# Kept absolute so a restarted server can find it from any directory
+		self.conf = os.path.abspath(conf)
+		
 		server_config = DEFAULTS
 		server_config.update(config)
 		server_config.update(runtime_conf)
 		
 		self.config = server_config
 		
-		assert self.config['APP'], u'You must provide a WSGI application'
+		assert self.config['APP'] or self.config['MOUNTS'], u'You must provide a WSGI application'
 		
 		# Setup the log...
 		logging.basicConfig(
@@ -79,6 +143,21 @@ class WSGIServer(object):
 		)
 		
 		self.log = logging.getLogger('cherryize')
+		
+		# Worker process PIDs (and start times) when running in prefork mode
+		self.workers = {}
+		self.is_worker = False
+		
+		# Each worker's number (0 up), kept when it's respawned
+		self.worker_slots = {}
+		self.worker_slot = 0
+		
+		self.metrics = None
+		self.profiler = None
+		self.access_log = None
+		
+		# PID of the replacement server while a restart is in progress
+		self.successor = None
 	
 	def run(self, cmd):
 		"""Command line startup"""
@@ -93,6 +172,8 @@ class WSGIServer(object):
 			self.stop()
 		elif cmd == 'RESTART':
 			self.restart()
+		elif cmd == 'PROFILE':
+			self.profile()
 		else:
 			self.log.critical(u'Unknown command "%s"!' % cmd)
 			sys.exit(1)
@@ -116,7 +197,20 @@ class WSGIServer(object):
 		
 		pid = None
 		
-		if self.config['SERVER_DAEMONIZE']:
+		# Set when we are replacing a running server (see restart)
+		inherited = os.environ.pop(LISTEN_FD_ENV, None)
+		parent_pid = os.environ.pop(PARENT_PID_ENV, None)
+		
+		if parent_pid:
+			# Already detached by the server we replace, take over its PID file
+			pid = os.getpid()
+			
+			if self.config['SERVER_DAEMONIZE']:
+				f = open(self.config['PID_FILE'], 'w')
+				f.write('%d' % pid)
+				f.close()
+		
+		elif self.config['SERVER_DAEMONIZE']:
 			# Double fork magic!
 			if os.path.exists(self.config['PID_FILE']):
 				self.log.critical(u'Unable to start server! PID file exists!!')
@@ -186,37 +280,168 @@ class WSGIServer(object):
 			pid = os.getpid()
 			std_err = sys.stderr
 			
-		application = import_object(self.config['APP'])
-		app = application()
+		app = self.load_application()
+		
+		if self.config['GZIP']:
+			app = GzipMiddleware(
+				app,
+				min_size=self.config['GZIP_MIN_SIZE'],
+				types=self.config['GZIP_TYPES'],
+				level=self.config['GZIP_LEVEL'],
+				cache_size=self.config['GZIP_CACHE_SIZE']
+			)
+		
+		# Cacheable responses are answered without calling the application
+		if self.config['CACHE']:
+			if self.config['CACHE_SHARED']:
+				# Created before the workers fork, so they all share it
+				store = SharedMemoryStore(self.config['CACHE_SIZE'], self.config['CACHE_SLOT_SIZE'])
+			else:
+				store = MemoryStore(self.config['CACHE_SIZE'])
+			
+			app = ResponseCache(
+				app,
+				store,
+				default_ttl=self.config['CACHE_TTL'],
+				stale=self.config['CACHE_STALE'],
+				max_entry_size=self.config['CACHE_MAX_ENTRY']
+			)
+		
+		# Static files are served before the application sees the request
+		if self.config['STATIC']:
+			app = StaticFiles(
+				app,
+				self.config['STATIC'],
+				max_age=self.config['STATIC_MAX_AGE'],
+				cache_size=self.config['STATIC_CACHE_SIZE'],
+				stat_interval=self.config['STATIC_STAT_INTERVAL'],
+				precompressed=self.config['GZIP']
+			)
+		
+		if self.config['METRICS']:
+			self.metrics = Metrics(self.config['METRICS_ROUTES'])
+			
+			if self.config['METRICS_PATH']:
+				app = MetricsApp(app, self.metrics, self.config['METRICS_PATH'])
+		
+		# The pool scales between min and max when a max is given
+		threads_min = self.config['SERVER_THREADS_MIN'] or self.config['SERVER_THREADS']
+		threads_max = self.config['SERVER_THREADS_MAX'] or -1
 		
 		# Setup the server
 		self.server = CherryPyWSGIServer(
 			(self.config['SERVER_IP'], self.config['SERVER_PORT']),
 			app,
 			server_name=self.config['SERVER_NAME'],
-			numthreads=self.config['SERVER_THREADS'],
-			max=-1,
+			numthreads=threads_min,
+			max=threads_max,
 			request_queue_size=self.config['SERVER_REQUEST_QUEUE_SIZE'],
 			timeout=self.config['SERVER_TIMEOUT']
 		)
 		
+		self.server.error_log = self.server_log
+		
+		# Admission control - answer 503 rather than queue without bound
+		self.server.requests.queue_limit = self.config['SERVER_QUEUE_LIMIT']
+		self.server.requests.queue_target = self.config['SERVER_QUEUE_TARGET']
+		self.server.requests.queue_interval = self.config['SERVER_QUEUE_INTERVAL']
+		self.server.retry_after = self.config['SERVER_RETRY_AFTER']
+		
 		self.server.environ['SERVER_SOFTWARE'] = 'Cherryize/%s %s' % (__version__, self.server.version)
 		self.server.environ['wsgi.errors'] = sys.stderr
 		
+		if self.config['SERVER_REUSE_PORT']:
+			self.server.reuse_port = True
+		
+		# Idle keep-alive connections wait in a poller, not a thread
+		self.server.park_idle = self.config['SERVER_PARK_IDLE']
+		
+		# Batch up small chunks of streamed responses
+		self.server.write_buffer_size = self.config['SERVER_WRITE_BUFFER']
+		
+		# Chunked uploads reach the app as they arrive, without a length
+		self.server.stream_chunked = self.config['SERVER_STREAM_CHUNKED']
+		
+		if self.metrics is not None:
+			self.metrics.server = self.server
+			self.server.metrics = self.metrics
+		
+		# Timelines of a sample of requests, for a trace viewer
+		if self.config['TRACE_FILE']:
+			self.server.hooks = ChromeTrace(self.config['TRACE_FILE'], self.config['TRACE_SAMPLE'])
+		
+		# Written by a thread of its own in each process serving requests
+		if self.config['ACCESS_LOG']:
+			self.access_log = AccessLog(
+				self.config['ACCESS_LOG'],
+				format=self.config['ACCESS_LOG_FORMAT'],
+				sample=self.config['ACCESS_LOG_SAMPLE'],
+				max_bytes=self.config['ACCESS_LOG_MAX_BYTES'],
+				backups=self.config['ACCESS_LOG_BACKUPS']
+			)
+			self.access_log.error_log = self.server_log
+			self.server.access_log = self.access_log
+		
+		# Started on SIGUSR2 (or the profile command)
+		self.profiler = SamplingProfiler(
+			self.server,
+			os.path.join(self.config['SERVER_RUN_DIR'], self.config['PROFILE_FILE']),
+			rate=self.config['PROFILE_RATE'],
+			seconds=self.config['PROFILE_SECONDS']
+		)
+		
 		# Setup SSL if it has been requested....
 		if self.config['SSL_CERTIFICATE'] and self.config['SSL_PRIVATE_KEY']:
 			self.server.ssl_certificate = self.config['SSL_CERTIFICATE']
 			self.server.ssl_private_key = self.config['SSL_PRIVATE_KEY']
 		
+		if inherited:
+			fd, family = [int(x) for x in inherited.split(':')]
+			self.server.inherit_socket(fd, family)
+		
 		# Init callback signals
 		signal.signal(signal.SIGUSR1, self.signal_handler)
+		signal.signal(signal.SIGUSR2, self.signal_handler)
 		signal.signal(signal.SIGHUP, self.signal_handler)
 		signal.signal(signal.SIGTERM, self.signal_handler)
+		signal.signal(signal.SIGQUIT, self.signal_handler)
+		
+		if self.config['SERVER_WORKERS'] > 1:
+			# Prefork - each worker process gets its own thread pool
+			self.server.environ['wsgi.multiprocess'] = True
+			
+			if not self.server.reuse_port and not inherited:
+				# One listening socket, inherited by every worker
+				try:
+					self.server.prepare()
+				except Exception, e:
+					self.log.error(u'Server failed %s' % e)
+					self.clean()
+					return
+			
+			self.log.info(u'Server is running. %s:%s / PID %s / %s workers' % (self.config['SERVER_IP'], self.config['SERVER_PORT'], pid, self.config['SERVER_WORKERS']))
+			if parent_pid:
+				self.retire(parent_pid)
+			
+			self.manage_workers()
+			return
 		
 		# Start....
 		try:
 			self.log.info(u'Server is running. %s:%s / PID %s' % (self.config['SERVER_IP'], self.config['SERVER_PORT'], pid))
-			self.server.start()
+			
+			self.serve_metrics()
+			self.start_access_log()
+			
+			if parent_pid:
+				if not inherited:
+					self.server.prepare()
+				
+				# Our socket is ready, the old server can drain and exit
+				self.retire(parent_pid)
+				self.server.serve()
+			else:
+				self.server.start()
 		except KeyboardInterrupt:
 			self.log.info(u'Server received keyboard interrupt - shutting down')
 			self.server.stop()
@@ -224,15 +449,184 @@ class WSGIServer(object):
 		except Exception, e:
 			self.log.error(u'Server failed %s' % e)
 			self.clean()
+		finally:
+			# Also when SIGTERM exits (or draining has finished)
+			self.close_access_log()
 	
-	def stop(self):
-		"""Stop a server if it's running"""
+	def load_application(self):
+		"""Import and create the application(s) we are serving"""
+		
+		if not self.config['MOUNTS']:
+			application = import_object(self.config['APP'])
+			return application()
+		
+		apps = {}
+		mounts = {}
+		
+		if self.config['APP']:
+			# Anything not mounted elsewhere
+			mounts['/'] = self.config['APP']
+		
+		mounts.update(self.config['MOUNTS'])
+		
+		for prefix, module_path in mounts.items():
+			# The same application mounted twice is only created once
+			if module_path not in apps:
+				apps[module_path] = import_object(module_path)()
+			
+			mounts[prefix] = apps[module_path]
+		
+		return MountDispatcher(mounts)
+	
+	def serve_metrics(self):
+		"""Serve the metrics on their own port, if there is one (each
+		worker uses the port after the previous worker's)"""
+		
+		if self.metrics is None or not self.config['METRICS_PORT']:
+			return
+		
+		bind_addr = (self.config['METRICS_IP'], self.config['METRICS_PORT'] + self.worker_slot)
+		
+		try:
+			# Shared with the server replacing us while a restart overlaps
+			self.metrics.serve(bind_addr, reuse_port=SO_REUSEPORT is not None)
+		except socket.error, e:
+			self.log.error(u'Unable to serve metrics on %s:%s - %s' % (bind_addr[0], bind_addr[1], e))
+	
+	def start_access_log(self):
+		"""Start writing the access log from this process"""
+		
+		if self.access_log is None:
+			return
+		
+		try:
+			self.access_log.start()
+		except (OSError, IOError), e:
+			self.log.error(u'Unable to open access log %s - %s' % (self.config['ACCESS_LOG'], e))
+			self.access_log = self.server.access_log = None
+	
+	def close_access_log(self):
+		"""Write what's left of the access log"""
+		
+		if self.access_log is None:
+			return
+		
+		try:
+			self.access_log.close()
+		except (OSError, IOError), e:
+			self.log.error(u'Unable to write access log %s - %s' % (self.config['ACCESS_LOG'], e))
+	
+	def server_log(self, msg='', level=logging.INFO, traceback=False):
+		"""Log messages from the underlying CherryPy server"""
+		
+		self.log.log(level, msg, exc_info=traceback)
+	
+	def manage_workers(self):
+		"""Fork the worker processes and respawn any that die"""
+		
+		try:
+			while True:
+				while len(self.workers) < self.config['SERVER_WORKERS']:
+					self.spawn_worker()
+				
+				try:
+					pid, status = os.wait()
+				except OSError, e:
+					if e.errno in (errno.EINTR, errno.ECHILD):
+						continue
+					raise
+				
+				started = self.workers.pop(pid, None)
+				self.worker_slots.pop(pid, None)
+				
+				if started is None:
+					continue
+				
+				self.log.warning(u'Worker %s exited (status %s) - respawning' % (pid, status))
+				
+				if time.time() - started < WORKER_RESPAWN_DELAY:
+					# Dying straight away, don't spin
+					time.sleep(WORKER_RESPAWN_DELAY)
+		
+		except KeyboardInterrupt:
+			self.log.info(u'Server received keyboard interrupt - shutting down')
+			self.stop_workers()
+			self.clean()
+	
+	def spawn_worker(self):
+		"""Fork a single worker process which serves from the shared socket"""
+		
+		taken = self.worker_slots.values()
+		slot = min([n for n in range(len(taken) + 1) if n not in taken])
+		
+		pid = os.fork()
+		
+		if pid:
+			self.workers[pid] = time.time()
+			self.worker_slots[pid] = slot
+			return pid
+		
+		# In the worker...
+		self.workers = {}
+		self.worker_slots = {}
+		self.worker_slot = slot
+		self.is_worker = True
+		
+		# Restarts are handled by the master
+		signal.signal(signal.SIGHUP, signal.SIG_IGN)
+		
+		status = 0
+		
+		try:
+			try:
+				if self.server.reuse_port:
+					# Each worker binds its own socket, the kernel balances
+					self.server.prepare()
+				
+				self.serve_metrics()
+				self.start_access_log()
+				self.server.serve()
+			except KeyboardInterrupt:
+				self.server.stop()
+			except SystemExit, e:
+				status = e.code or 0
+			except Exception, e:
+				self.log.error(u'Worker %s failed %s' % (os.getpid(), e))
+				status = 1
+		finally:
+			self.close_access_log()
+			
+			# Never fall back into the master's loop
+			os._exit(status)
+	
+	def stop_workers(self, sig=signal.SIGTERM):
+		"""Stop all worker processes and wait for them to exit"""
+		
+		for pid in self.workers.keys():
+			try:
+				os.kill(pid, sig)
+			except OSError:
+				self.workers.pop(pid)
+		
+		while self.workers:
+			try:
+				pid, status = os.wait()
+			except OSError, e:
+				if e.errno == errno.EINTR:
+					continue
+				break
+			
+			self.workers.pop(pid, None)
+		
+		self.workers = {}
+		self.worker_slots = {}
+	
+	def read_pid(self):
+		"""Read the PID of the running server, None if there isn't one"""
 		
 		# See if there is a valid process ID
 		if not os.path.exists(self.config['PID_FILE']):
-			# Server is already stopped
-			self.log.warning(u'Trying to stop a server that does not exist! (PID file %s)' % self.config['PID_FILE'])
-			return
+			return None
 		
 		try:
 			f = open(self.config['PID_FILE'], 'r')
@@ -248,6 +642,18 @@ class WSGIServer(object):
 			self.log.critical(u'PID file does not contain a valid Process ID!')
 			sys.exit(1)
 		
+		return pid
+	
+	def stop(self):
+		"""Stop a server if it's running"""
+		
+		pid = self.read_pid()
+		
+		if pid is None:
+			# Server is already stopped
+			self.log.warning(u'Trying to stop a server that does not exist! (PID file %s)' % self.config['PID_FILE'])
+			return
+		
 		try:
 			os.kill(pid, signal.SIGTERM)
 		except OSError, e:
@@ -257,9 +663,115 @@ class WSGIServer(object):
 	def restart(self):
 		"""Attempt to restart a running server gracefully"""
 		
-		# @@ TODO: Add restart facility
-		pass
+		if hasattr(self, 'server'):
+			# We are the running server
+			self.handoff()
+			return
+		
+		# Command line - ask the running server to replace itself
+		pid = self.read_pid()
+		
+		if pid is None:
+			self.log.warning(u'Trying to restart a server that does not exist - starting it')
+			self.start()
+			return
+		
+		try:
+			os.kill(pid, signal.SIGHUP)
+		except OSError, e:
+			self.log.critical(u'Unable to signal process - %s' % e)
+			sys.exit(1)
+	
+	def profile(self):
+		"""Ask a running server to profile its worker threads"""
+		
+		pid = self.read_pid()
+		
+		if pid is None:
+			self.log.warning(u'Trying to profile a server that does not exist! (PID file %s)' % self.config['PID_FILE'])
+			sys.exit(1)
+		
+		try:
+			os.kill(pid, signal.SIGUSR2)
+		except OSError, e:
+			self.log.critical(u'Unable to signal process - %s' % e)
+			sys.exit(1)
+		
+		self.log.info(u'Profiling PID %s for %s seconds - the log will say where the profile is written' % (pid, self.config['PROFILE_SECONDS']))
+	
+	def handoff(self):
+		"""Exec a fresh server which takes over our listening socket
+		
+		The new server loads the application while we carry on serving, then
+		sends us SIGQUIT. We stop accepting, finish the connections we have
+		already queued and exit, so no connection is refused along the way.
+		"""
+		
+		if self.successor:
+			try:
+				pid, status = os.waitpid(self.successor, os.WNOHANG)
+			except OSError:
+				pid = self.successor
+			
+			if not pid:
+				self.log.warning(u'Restart already in progress (PID %s)' % self.successor)
+				return
+			
+			self.log.error(u'Previous restart (PID %s) failed - retrying' % self.successor)
+			self.successor = None
+		
+		env = os.environ.copy()
+		env[PARENT_PID_ENV] = str(os.getpid())
+		env['PYTHONPATH'] = os.pathsep.join([p for p in sys.path if p])
+		
+		fd = None
+		sock = getattr(self.server, 'socket', None)
+		
+		if sock is not None and not self.server.reuse_port:
+			# (With SO_REUSEPORT the new server simply binds alongside us)
+			if isinstance(self.server.bind_addr, basestring):
+				family = socket.AF_UNIX
+			elif len(sock.getsockname()) == 4:
+				family = socket.AF_INET6
+			else:
+				family = socket.AF_INET
+			
+			fd = sock.fileno()
+			env[LISTEN_FD_ENV] = '%d:%d' % (fd, family)
+		
+		args = [
+			sys.executable, '-c', 'from cherryize.server import main; main()',
+			'--conf=%s' % self.conf, 'start'
+		]
+		
+		try:
+			pid = os.fork()
+		except OSError, e:
+			self.log.error(u'Unable to restart server - Can not fork: %s' % e)
+			return
+		
+		if pid == 0:
+			try:
+				if fd is not None:
+					# Let the listening socket survive the exec
+					flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+					fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+				
+				os.execve(sys.executable, args, env)
+			finally:
+				os._exit(1)
+		
+		self.successor = pid
+		self.log.info(u'Started replacement server - PID %s' % pid)
+	
+	def retire(self, pid):
+		"""Tell the server we are replacing to drain and exit"""
 		
+		try:
+			os.kill(int(pid), signal.SIGQUIT)
+		except OSError, e:
+			self.log.warning(u'Unable to signal previous server %s - %s' % (pid, e))
+	
 	def clean(self):
 		"""Attempt to clean up the environment if running as a deamon"""
 		
@@ -274,21 +786,75 @@ class WSGIServer(object):
 		"""Handle OS signals sent to the server"""
 		
 		if sig == signal.SIGUSR1:
-			pass
+			if self.workers:
+				# The workers have the metrics and access logs
+				for pid in self.workers.keys():
+					try:
+						os.kill(pid, signal.SIGUSR1)
+					except OSError:
+						pass
+			
+			else:
+				if self.metrics is not None:
+					self.log.info(u'Metrics (PID %s):\n%s' % (os.getpid(), self.metrics.exposition()))
+				
+				# After logrotate has moved it
+				if self.access_log is not None:
+					self.access_log.reopen()
+			
+		elif sig == signal.SIGUSR2:
+			if self.workers:
+				# Each worker profiles its own threads
+				for pid in self.workers.keys():
+					try:
+						os.kill(pid, signal.SIGUSR2)
+					except OSError:
+						pass
+			
+			elif self.profiler is not None:
+				path = self.profiler.start()
+				
+				if path is None:
+					self.log.warning(u'Server recieved SIGUSR2 - already profiling')
+				else:
+					self.log.info(u'Server recieved SIGUSR2 - profiling for %ss into %s' % (self.config['PROFILE_SECONDS'], path))
 			
 		elif sig == signal.SIGHUP:
 			self.log.info(u'Server recieved SIGHUP - restarting')
 			
 			self.restart()
 			
+		elif sig == signal.SIGTERM and self.is_worker:
+			self.server.stop()
+			sys.exit(0)
+			
+		elif sig == signal.SIGQUIT and self.is_worker:
+			self.server.drain()
+			
 		elif sig == signal.SIGTERM:
 			self.log.info(u'Server recieved SIGTERM - shutting down')
 			
-			self.server.stop()
+			if self.workers:
+				self.stop_workers()
+			else:
+				self.server.stop()
+			
 			self.clean()
 			
 			sys.exit(0)
 			
+		elif sig == signal.SIGQUIT:
+			self.log.info(u'Server recieved SIGQUIT - draining and exiting')
+			
+			if self.workers:
+				self.stop_workers(signal.SIGQUIT)
+				
+				# The PID file belongs to the server which replaced us now
+				sys.exit(0)
+			
+			# serve() returns once the queued connections are done
+			self.server.drain()
+			
 		else:
 			self.log.warning(u'Server recieved unknown signal "%s" - ignoring' % sig)
 			
@@ -296,8 +862,6 @@ class WSGIServer(object):
 		# TERM, INT
 		# QUIT
 		# HUP
-		# USR1
-		# USR2
 		# WINCH
 		
 def main():
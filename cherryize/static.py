@@ -0,0 +1,356 @@
+"""Static file serving for Cherryize
+
+Serves files straight from disk for the URL prefixes given in the STATIC
+setting, before the request reaches the WSGI application.
+"""
+
+import os
+import os.path
+import mimetypes
+import rfc822
+import stat
+import threading
+import time
+
+from cherryize.wsgiserver import FileWrapper
+from cherryize.compress import accepts_gzip
+
+__all__ = ('StaticFiles',)
+
+# Files up to this size are kept in memory, larger ones are sent with sendfile
+SMALL_FILE_SIZE = 64 * 1024
+
+# How many paths (found or not) the stat cache remembers
+STAT_CACHE_ENTRIES = 10000
+
+class StaticFile(object):
+	"""What we know about a file: its stat results and response validators"""
+
+	def __init__(self, path, st):
+		self.path = path
+		self.size = st.st_size
+		self.mtime = int(st.st_mtime)
+		self.ident = (st.st_ino, st.st_size, st.st_mtime)
+		self.etag = '"%x-%x"' % (self.mtime, self.size)
+		self.last_modified = rfc822.formatdate(self.mtime)
+		self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+class StaticFiles(object):
+	"""WSGI middleware serving files for a set of URL prefixes
+
+	mounts maps URL prefixes to directories. Files are stat'ed at most once
+	every stat_interval seconds, small files are kept in an LRU cache of up to
+	cache_size bytes, and responses carry ETag/Last-Modified (answering
+	conditional requests with a 304) and support a single byte range.
+
+	With precompressed, a 'name.gz' next to a file is sent in its place
+	(gzip encoded) to clients which accept gzip.
+	"""
+
+	def __init__(self, app, mounts, max_age=0, cache_size=16 * 1024 * 1024, stat_interval=1, precompressed=False):
+		self.app = app
+		self.precompressed = precompressed
+
+		# Longest prefix first, so /static/admin wins over /static
+		self.mounts = sorted(
+			[(prefix.rstrip('/') + '/', os.path.abspath(root)) for prefix, root in mounts.items()],
+			key=lambda m: len(m[0]), reverse=True
+		)
+
+		self.cache_control = max_age and 'max-age=%d' % max_age or None
+		self.cache_size = cache_size
+		self.stat_interval = stat_interval
+
+		self.lock = threading.Lock()
+
+		# (root, name) -> (time checked, StaticFile or None)
+		self.stats = {}
+
+		# path -> (ident, data) and path -> when it was last served
+		self.data = {}
+		self.data_used = {}
+		self.data_size = 0
+
+	def __call__(self, environ, start_response):
+		path = environ.get('PATH_INFO') or '/'
+
+		for prefix, root in self.mounts:
+			if path.startswith(prefix):
+				return self.serve(environ, start_response, root, path[len(prefix):])
+
+		return self.app(environ, start_response)
+
+	def serve(self, environ, start_response, root, name):
+		"""Serve the file 'name' from the directory 'root'"""
+
+		method = environ['REQUEST_METHOD']
+
+		if method not in ('GET', 'HEAD'):
+			return self.error(start_response, '405 Method Not Allowed', [('Allow', 'GET, HEAD')])
+
+		f = self.stat(root, name)
+
+		if f is None:
+			return self.error(start_response, '404 Not Found')
+
+		content_type = f.content_type
+		headers = []
+
+		if self.precompressed:
+			gz = self.stat(root, name + '.gz')
+
+			if gz is not None:
+				headers.append(('Vary', 'Accept-Encoding'))
+
+				# Ranges are of the file as it is, so those come from the original
+				if accepts_gzip(environ) and 'HTTP_RANGE' not in environ:
+					headers.append(('Content-Encoding', 'gzip'))
+					f = gz
+
+		headers.extend([
+			('ETag', f.etag),
+			('Last-Modified', f.last_modified),
+			('Accept-Ranges', 'bytes'),
+		])
+
+		if self.cache_control:
+			headers.append(('Cache-Control', self.cache_control))
+
+		if self.not_modified(environ, f):
+			start_response('304 Not Modified', headers)
+			return []
+
+		headers.append(('Content-Type', content_type))
+
+		start, end = 0, f.size - 1
+		status = '200 OK'
+
+		byte_range = self.byte_range(environ, f)
+
+		if byte_range == 'unsatisfiable':
+			return self.error(start_response, '416 Requested Range Not Satisfiable', [
+				('Content-Range', 'bytes */%d' % f.size),
+			])
+
+		if byte_range:
+			start, end = byte_range
+			status = '206 Partial Content'
+			headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, f.size)))
+
+		length = end - start + 1
+		headers.append(('Content-Length', str(length)))
+
+		if f.size <= SMALL_FILE_SIZE and f.size <= self.cache_size:
+			data = self.read(f)
+
+			if data is None:
+				return self.error(start_response, '404 Not Found')
+
+			start_response(status, headers)
+
+			if method == 'HEAD':
+				return []
+
+			if length == f.size:
+				return [data]
+
+			return [data[start:end + 1]]
+
+		try:
+			fh = open(f.path, 'rb')
+		except IOError:
+			return self.error(start_response, '404 Not Found')
+
+		start_response(status, headers)
+
+		if method == 'HEAD':
+			fh.close()
+			return []
+
+		# The server sends from the current position up to the Content-Length
+		fh.seek(start)
+
+		file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+		return file_wrapper(fh, 64 * 1024)
+
+	def stat(self, root, name):
+		"""Return a StaticFile for the regular file 'name' under 'root' (or
+		None), re-checking the disk at most every stat_interval seconds"""
+
+		now = time.time()
+		key = (root, name)
+
+		# Lookups are plain dict reads, only updates take the lock
+		cached = self.stats.get(key)
+
+		if cached is not None and now - cached[0] < self.stat_interval:
+			return cached[1]
+
+		path = os.path.normpath(os.path.join(root, name))
+		f = None
+
+		# Nothing outside the mounted directory
+		if '\0' not in path and path.startswith(root + os.sep):
+			try:
+				st = os.stat(path)
+			except OSError:
+				pass
+			else:
+				if stat.S_ISREG(st.st_mode):
+					f = StaticFile(path, st)
+
+		if cached is not None and f is not None and cached[1] is not None and cached[1].ident == f.ident:
+			# Unchanged, keep the validators we already have
+			f = cached[1]
+
+		with self.lock:
+			if len(self.stats) >= STAT_CACHE_ENTRIES:
+				# Cheaper than tracking ages - the hot paths come straight back
+				self.stats.clear()
+
+			self.stats[key] = (now, f)
+
+		return f
+
+	def read(self, f):
+		"""Return the contents of a small file, from the LRU cache if we can"""
+
+		cached = self.data.get(f.path)
+
+		if cached is not None and cached[0] == f.ident:
+			self.data_used[f.path] = time.time()
+			return cached[1]
+
+		try:
+			fh = open(f.path, 'rb')
+			try:
+				data = fh.read()
+			finally:
+				fh.close()
+		except IOError:
+			return None
+
+		if len(data) != f.size:
+			# Changed under us - serve it, but don't cache it
+			return data
+
+		with self.lock:
+			old = self.data.get(f.path)
+
+			if old is not None:
+				# The file has changed since we read it
+				self.data_size -= len(old[1])
+
+			self.data[f.path] = (f.ident, data)
+			self.data_used[f.path] = time.time()
+			self.data_size += len(data)
+
+			if self.data_size > self.cache_size:
+				self.evict()
+
+		return data
+
+	def evict(self):
+		"""Drop the least recently served files until we are within
+		cache_size (called with the lock held)"""
+
+		by_age = sorted(self.data_used.items(), key=lambda item: item[1])
+
+		for path, used in by_age:
+			if self.data_size <= self.cache_size:
+				break
+
+			# A hit may have touched a path we have already dropped
+			del self.data_used[path]
+			entry = self.data.pop(path, None)
+
+			if entry is not None:
+				self.data_size -= len(entry[1])
+
+	def not_modified(self, environ, f):
+		"""Is the client's copy (If-None-Match / If-Modified-Since) current?"""
+
+		if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+
+		if if_none_match:
+			tags = [t.strip() for t in if_none_match.split(',')]
+			return '*' in tags or f.etag in tags or ('W/' + f.etag) in tags
+
+		since = self.parse_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+
+		return since is not None and f.mtime <= since
+
+	def byte_range(self, environ, f):
+		"""Return the (start, end) of a single requested byte range, None to
+		send the whole file, or 'unsatisfiable'"""
+
+		value = environ.get('HTTP_RANGE')
+
+		if not value or not value.startswith('bytes=') or ',' in value:
+			# Not asked for, not bytes, or more than one range - all of it
+			return None
+
+		if_range = environ.get('HTTP_IF_RANGE')
+
+		if if_range:
+			# Only send part of the file if it's the version the client has
+			if if_range.startswith('"') or if_range.startswith('W/'):
+				if if_range != f.etag:
+					return None
+			elif self.parse_date(if_range) != f.mtime:
+				return None
+
+		first, sep, last = value[6:].strip().partition('-')
+
+		try:
+			if not first:
+				# The last N bytes
+				length = int(last)
+
+				# An empty file has no last bytes to give
+				if length <= 0 or not f.size:
+					return 'unsatisfiable'
+
+				return max(f.size - length, 0), f.size - 1
+
+			start = int(first)
+			if last:
+				end = int(last)
+			else:
+				end = f.size - 1
+		except ValueError:
+			return None
+
+		if start >= f.size:
+			return 'unsatisfiable'
+
+		if end < start:
+			return None
+
+		return start, min(end, f.size - 1)
+
+	def parse_date(self, value):
+		"""Parse an HTTP date into seconds since the epoch (or None)"""
+
+		if not value:
+			return None
+
+		parsed = rfc822.parsedate_tz(value)
+
+		if parsed is None:
+			return None
+
+		try:
+			return rfc822.mktime_tz(parsed)
+		except (OverflowError, ValueError):
+			return None
+
+	def error(self, start_response, status, headers=[]):
+		body = status[4:]
+
+		start_response(status, [
+			('Content-Type', 'text/plain'),
+			('Content-Length', str(len(body))),
+		] + headers)
+
+		return [body]
@@ -0,0 +1,149 @@
+"""Request timelines for Cherryize
+
+Records how long a sample of requests spent in each phase - waiting for a
+worker thread, being parsed, in the application and being sent - and
+appends them to a file in the Chrome trace event format, which can be
+opened in chrome://tracing or Perfetto.
+"""
+
+import json
+import os
+import random
+import threading
+
+from cherryize.wsgiserver import ServerHooks
+
+__all__ = ('ChromeTrace',)
+
+class ChromeTrace(ServerHooks):
+	"""Server hooks writing the timelines of sampled requests to path
+
+	sample is the fraction of requests traced. Each request's events are
+	appended to the file in one write, so the threads and worker processes
+	of a server can all share it. The file is left without its closing ']',
+	which the trace viewers allow.
+	"""
+
+	def __init__(self, path, sample=0.01):
+		self.path = path
+		self.sample = sample
+
+		self.fd = None
+		self.pid = None
+		self.lock = threading.Lock()
+
+		# (pid, thread) of the threads whose names have been written
+		self.named = set()
+
+	def enqueued(self, conn, t):
+		conn.trace_enqueued = t
+		conn.trace_dequeued = None
+
+	def dequeued(self, conn, t):
+		conn.trace_dequeued = t
+
+	def request_started(self, conn, req, t):
+		if random.random() >= self.sample:
+			return
+
+		req.trace = {'started': t}
+
+	def request_parsed(self, conn, req, t):
+		trace = getattr(req, 'trace', None)
+
+		if trace is not None:
+			trace['parsed'] = t
+
+	def app_called(self, conn, req, t):
+		trace = getattr(req, 'trace', None)
+
+		if trace is not None:
+			trace['called'] = t
+
+	def app_returned(self, conn, req, t):
+		trace = getattr(req, 'trace', None)
+
+		if trace is not None:
+			trace['returned'] = t
+
+	def response_sent(self, conn, req, t):
+		trace = getattr(req, 'trace', None)
+
+		if trace is None:
+			conn.trace_dequeued = None
+			return
+
+		req.trace = None
+		thread = threading.currentThread()
+		tid = thread.ident
+		pid = os.getpid()
+
+		events = []
+
+		if (pid, tid) not in self.named:
+			self.named.add((pid, tid))
+			events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+				'args': {'name': thread.getName()}})
+
+		def span(name, start, end, args=None):
+			if start is None or end is None:
+				return
+
+			event = {'name': name, 'cat': 'cherryize', 'ph': 'X', 'pid': pid, 'tid': tid,
+				'ts': round(start * 1000000, 3), 'dur': round((end - start) * 1000000, 3)}
+
+			if args is not None:
+				event['args'] = args
+
+			events.append(event)
+
+		# Only when the connection was queued for this request (it isn't
+		# between the requests on a busy keep-alive connection)
+		dequeued = getattr(conn, 'trace_dequeued', None)
+
+		if dequeued is not None:
+			span('queued', conn.trace_enqueued, dequeued)
+			conn.trace_dequeued = None
+
+		environ = req.environ
+		span('request', trace['started'], t, {
+			'method': environ.get('REQUEST_METHOD', ''),
+			'path': (environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')).decode('latin-1'),
+			'status': req.status or '',
+		})
+		span('parse', trace['started'], trace.get('parsed'))
+		span('app', trace.get('called'), trace.get('returned'))
+		span('respond', trace.get('returned'), t)
+
+		self.write(''.join([json.dumps(event, separators=(',', ':')) + ',\n' for event in events]))
+
+	def write(self, data):
+		"""Append to the file, opening it in this process if need be"""
+
+		if self.pid != os.getpid():
+			self.lock.acquire()
+			try:
+				if self.pid != os.getpid():
+					self.open()
+			finally:
+				self.lock.release()
+
+		try:
+			os.write(self.fd, data)
+		except (OSError, TypeError):
+			# Don't fail requests because a trace couldn't be written
+			pass
+
+	def open(self):
+		try:
+			# Whoever creates the file starts the JSON array
+			fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0644)
+			os.write(fd, '[\n')
+		except OSError:
+			try:
+				fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+			except OSError:
+				fd = None
+
+		self.fd = fd
+		self.pid = os.getpid()
@@ -78,19 +78,20 @@ number of requests and their responses, so we run a nested loop:
 
 
 import base64
+import collections
 import os
 import Queue
 import re
 quoted_slash = re.compile("(?i)%2F")
 import rfc822
+import select
 import socket
+import stat
 try:
     import cStringIO as StringIO
 except ImportError:
     import StringIO
 
-_fileobject_uses_str_type = isinstance(socket._fileobject(None)._rbuf, basestring)
-
 import sys
 import threading
 import time
@@ -137,6 +138,113 @@ socket_errors_to_ignore.append("timed out")
 socket_errors_nonblocking = plat_specific_errors(
     'EAGAIN', 'EWOULDBLOCK', 'WSAEWOULDBLOCK')
 
+# Older Pythons don't export SO_REUSEPORT even where the kernel has it.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+if SO_REUSEPORT is None and sys.platform.startswith("linux"):
+    SO_REUSEPORT = 15
+
+# Linux only: hold back partial segments until the socket is uncorked.
+TCP_CORK = getattr(socket, "TCP_CORK", None)
+
+# os.sendfile only exists from Python 3.3; on older Pythons call the
+# Linux system call through ctypes.
+sendfile = getattr(os, "sendfile", None)
+if sendfile is None and sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _sendfile64 = _libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        pass
+    else:
+        _sendfile64.argtypes = [ctypes.c_int, ctypes.c_int,
+                                ctypes.POINTER(ctypes.c_int64),
+                                ctypes.c_size_t]
+        _sendfile64.restype = ctypes.c_ssize_t
+        
+        def sendfile(out_fd, in_fd, offset, count):
+            """Copy count bytes from in_fd (at offset) to out_fd."""
+            offset = ctypes.c_int64(offset)
+            sent = _sendfile64(out_fd, in_fd, ctypes.byref(offset), count)
+            if sent < 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e))
+            return sent
+
+# time.monotonic only exists from Python 3.3; on older Pythons read
+# CLOCK_MONOTONIC through ctypes (and failing that, use time.time).
+monotonic = getattr(time, "monotonic", None)
+if monotonic is None and sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        import ctypes.util
+        _librt = ctypes.CDLL(ctypes.util.find_library("rt")
+                             or ctypes.util.find_library("c"), use_errno=True)
+        _clock_gettime = _librt.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        pass
+    else:
+        class _timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+        
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        _CLOCK_MONOTONIC = 1
+        
+        def monotonic():
+            """Return seconds on a clock which never goes back (from an
+            arbitrary starting point, the same for every process)."""
+            t = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)):
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e))
+            return t.tv_sec + t.tv_nsec * 1e-9
+if monotonic is None:
+    monotonic = time.time
+
+
+_date_header = (None, "")
+
+def date_header():
+    """Return the "Date: ...\r\n" header line for the current second.
+    
+    It is formatted once a second, not once per response.
+    """
+    global _date_header
+    now = int(time.time())
+    second, line = _date_header
+    if second != now:
+        line = "Date: %s\r\n" % rfc822.formatdate(now)
+        _date_header = (now, line)
+    return line
+
+
+# Status lines and Server headers, formatted once and then reused. Apps
+# can make up their own status lines, so stop adding to them at some point.
+_status_lines = {}
+_server_headers = {}
+_max_cached_lines = 512
+
+def status_line(protocol, status):
+    """Return the "HTTP/1.1 200 OK\r\n" Status-Line."""
+    try:
+        return _status_lines[protocol, status]
+    except KeyError:
+        line = "%s %s\r\n" % (protocol, status)
+        if len(_status_lines) < _max_cached_lines:
+            _status_lines[protocol, status] = line
+        return line
+
+def server_header(software):
+    """Return the "Server: ...\r\n" header line."""
+    try:
+        return _server_headers[software]
+    except KeyError:
+        line = "Server: %s\r\n" % software
+        if len(_server_headers) < _max_cached_lines:
+            _server_headers[software] = line
+        return line
+
 comma_separated_headers = ['ACCEPT', 'ACCEPT-CHARSET', 'ACCEPT-ENCODING',
     'ACCEPT-LANGUAGE', 'ACCEPT-RANGES', 'ALLOW', 'CACHE-CONTROL',
     'CONNECTION', 'CONTENT-ENCODING', 'CONTENT-LANGUAGE', 'EXPECT',
@@ -170,7 +278,7 @@ class WSGIPathInfoDispatcher(object):
         for p, app in self.apps:
             # The apps list should be sorted by length, descending.
             if path.startswith(p + "/") or path == p:
-                environ = environ.copy()
+                # Each request has its own environ, so change it in place.
                 environ["SCRIPT_NAME"] = environ["SCRIPT_NAME"] + p
                 environ["PATH_INFO"] = path[len(p):]
                 return app(environ, start_response)
@@ -183,6 +291,10 @@ class WSGIPathInfoDispatcher(object):
 class MaxSizeExceeded(Exception):
     pass
 
+class ChunkedBodyError(IOError):
+    """Raised by ChunkedRFile for a malformed or truncated chunked body."""
+    pass
+
 class SizeCheckWrapper(object):
     """Wraps a file-like object, raising MaxSizeExceeded if too large."""
     
@@ -220,6 +332,15 @@ class SizeCheckWrapper(object):
             if len(data) < 256 or data[-1:] == "\n":
                 return ''.join(res)
     
+    def readheaderblock(self):
+        limit = None
+        if self.maxlen:
+            limit = self.maxlen - self.bytes_read
+        data = self.rfile.readheaderblock(limit)
+        self.bytes_read += len(data)
+        self._check_length()
+        return data
+    
     def readlines(self, sizehint=0):
         # Shamelessly stolen from StringIO
         total = 0
@@ -246,6 +367,242 @@ class SizeCheckWrapper(object):
         return data
 
 
+class ChunkedRFile(object):
+    """Wraps a file-like object, decoding the 'chunked' transfer coding
+    as the request body is read (rather than all before the app runs).
+    
+    rfile: the connection's SizeCheckWrapper, whose maxlen limits the
+        size of the body (framing included).
+    read_trailers: called after the last-chunk, to read any trailer
+        headers into the environ.
+    
+    Malformed framing, or the client closing the connection before the
+    last-chunk, raises ChunkedBodyError (an IOError, which is what apps
+    expect from a broken upload).
+    """
+    
+    def __init__(self, rfile, read_trailers):
+        self.rfile = rfile
+        self.read_trailers = read_trailers
+        # Bytes of the current chunk not yet read.
+        self.left = 0
+        self.started = False
+        self.done = False
+    
+    def _next_chunk(self):
+        """Move on to the next chunk. Return False once the body is done."""
+        if self.done:
+            return False
+        
+        if self.started:
+            crlf = self.rfile.read(2)
+            if crlf != "\r\n":
+                raise ChunkedBodyError("Bad chunked transfer coding "
+                              "(expected '\\r\\n', got %r)" % crlf)
+        self.started = True
+        
+        line = self.rfile.readline()
+        try:
+            chunk_size = int(line.strip().split(";", 1)[0], 16)
+        except ValueError:
+            raise ChunkedBodyError("Bad chunked transfer coding "
+                          "(expected a chunk size, got %r)" % line)
+##        chunk_extension = line.split(";", 1)[1:]
+        if chunk_size <= 0:
+            self.done = True
+            # Grab any trailer headers
+            try:
+                self.read_trailers()
+            except ValueError, ex:
+                raise ChunkedBodyError(*ex.args)
+            return False
+        
+        self.left = chunk_size
+        return True
+    
+    def read(self, size=None):
+        if size is None or size < 0:
+            size = -1
+        buffers = []
+        while size:
+            if not self.left and not self._next_chunk():
+                break
+            if size < 0:
+                n = self.left
+            else:
+                n = min(self.left, size)
+                size -= n
+            data = self.rfile.read(n)
+            if len(data) < n:
+                raise ChunkedBodyError("Request body ended mid-chunk.")
+            self.left -= n
+            buffers.append(data)
+        return "".join(buffers)
+    
+    def readline(self, size=None):
+        if size is None or size < 0:
+            size = -1
+        buffers = []
+        while size:
+            if not self.left and not self._next_chunk():
+                break
+            if size < 0:
+                n = self.left
+            else:
+                n = min(self.left, size)
+            line = self.rfile.readline(n)
+            if not line:
+                raise ChunkedBodyError("Request body ended mid-chunk.")
+            self.left -= len(line)
+            if size > 0:
+                size -= len(line)
+            buffers.append(line)
+            if line[-1:] == "\n":
+                break
+        return "".join(buffers)
+    
+    def readlines(self, sizehint=0):
+        # Shamelessly stolen from StringIO
+        total = 0
+        lines = []
+        line = self.readline()
+        while line:
+            lines.append(line)
+            total += len(line)
+            if 0 < sizehint <= total:
+                break
+            line = self.readline()
+        return lines
+    
+    def close(self):
+        pass
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+class ContinueRFile(object):
+    """Wraps wsgi.input for a request with "Expect: 100-continue",
+    calling send_continue the first time the app reads from it."""
+    
+    def __init__(self, rfile, send_continue):
+        self.rfile = rfile
+        self.send_continue = send_continue
+    
+    def _continue(self):
+        if self.send_continue is not None:
+            send_continue, self.send_continue = self.send_continue, None
+            send_continue()
+    
+    def read(self, size=None):
+        self._continue()
+        return self.rfile.read(size)
+    
+    def readline(self, size=None):
+        self._continue()
+        return self.rfile.readline(size)
+    
+    def readlines(self, sizehint=0):
+        self._continue()
+        return self.rfile.readlines(sizehint)
+    
+    def close(self):
+        self.rfile.close()
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        self._continue()
+        return self.rfile.next()
+
+
+class FileWrapper(object):
+    """The wsgi.file_wrapper callable.
+    
+    Iterating it reads the file in blksize chunks, as PEP 333 asks, but
+    HTTPRequest recognizes it and (for a regular file on a plain socket)
+    sends the file with sendfile instead, from the file's current
+    position up to the response's Content-Length.
+    """
+    
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, "close"):
+            self.close = filelike.close
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+    
+    def fileno(self):
+        """Return the file descriptor of a regular file, else None."""
+        try:
+            fd = self.filelike.fileno()
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                return fd
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+        return None
+
+
+class ServerHooks(object):
+    """Callbacks at the boundaries between the phases of handling requests.
+    
+    Give an instance (of a subclass defining the methods it needs) to
+    CherryPyWSGIServer.hooks. Each method is passed the connection and
+    request concerned and the time, from monotonic(). They are called on
+    the thread doing the work, so they must be quick. State can be carried
+    from one phase to the next as attributes of the connection or request.
+    
+    accepted(conn, t): tick has accepted the connection.
+    enqueued(conn, t): the connection has been put on the Queue (when it
+        is accepted, and again when a parked connection has a request).
+    dequeued(conn, t): a worker thread has taken it off the Queue.
+    request_started(conn, req, t): the request line has arrived.
+    request_parsed(conn, req, t): the request line and headers are parsed.
+    app_called(conn, req, t): the WSGI app is about to be called.
+    app_returned(conn, req, t): the WSGI app has returned its iterable.
+    response_sent(conn, req, t): all of the response has been sent.
+    """
+    
+    def accepted(self, conn, t):
+        pass
+    
+    def enqueued(self, conn, t):
+        pass
+    
+    def dequeued(self, conn, t):
+        pass
+    
+    def request_started(self, conn, req, t):
+        pass
+    
+    def request_parsed(self, conn, req, t):
+        pass
+    
+    def app_called(self, conn, req, t):
+        pass
+    
+    def app_returned(self, conn, req, t):
+        pass
+    
+    def response_sent(self, conn, req, t):
+        pass
+
+
 class HTTPRequest(object):
     """An HTTP Request (and response).
     
@@ -279,10 +636,43 @@ class HTTPRequest(object):
     chunked_write: if True, output will be encoded with the "chunked"
         transfer-coding. This value is set automatically inside
         send_headers.
+    expect_continue: True while the client is waiting for a
+        "100 Continue" before it sends the request body.
+    outbuf: response data (the header block, body chunks and chunked
+        framing) waiting to be sent by flush. Queuing it lets the headers
+        and the first chunk of the body go out in a single sendall.
+    headers_queued: True once the header block has been put in outbuf.
+        sent_headers only becomes True when flush has sent it, so until
+        then an error response can still be sent instead.
+    coalesce_size: chunks at least this big are not copied into the
+        same sendall as the data queued before them.
+    write_buffer_size: if non-zero, chunks yielded by a streaming (not a
+        list or tuple) response are queued until at least this many bytes
+        are waiting. The application can still push data out at once by
+        yielding an empty string, or by using the write() callable, which
+        always flushes. If 0, each chunk is sent as it is yielded.
+    stream_chunked: if False (the default), a chunked request body is
+        read and decoded before the app is called, and given to it with
+        a CONTENT_LENGTH. If True, it is decoded as the app reads it, with
+        no CONTENT_LENGTH and wsgi.input_terminated set instead, which
+        apps that only trust CONTENT_LENGTH don't understand.
+    started: the time (time.time()) the request line was read.
+    request_line: the request line as it was read (without the CRLF).
+    conn, hooks: the HTTPConnection and its ServerHooks (set only when
+        there are hooks).
     """
     
     max_request_header_size = 0
     max_request_body_size = 0
+    coalesce_size = 16384
+    write_buffer_size = 0
+    stream_chunked = False
+    corked = False
+    expect_continue = False
+    started = None
+    request_line = None
+    conn = None
+    hooks = None
     
     def __init__(self, wfile, environ, wsgi_app):
         self.rfile = environ['wsgi.input']
@@ -294,9 +684,12 @@ class HTTPRequest(object):
         self.started_response = False
         self.status = ""
         self.outheaders = []
+        self.headers_queued = False
         self.sent_headers = False
         self.close_connection = False
         self.chunked_write = False
+        self.outbuf = []
+        self.outbuf_size = 0
     
     def parse_request(self):
         """Parse the next HTTP request start-line and message-headers."""
@@ -323,6 +716,11 @@ class HTTPRequest(object):
             self.ready = False
             return
         
+        # The request has arrived (the time it took isn't the server's).
+        self.started = time.time()
+        if self.hooks is not None:
+            self.hooks.request_started(self.conn, self, monotonic())
+        
         if request_line == "\r\n":
             # RFC 2616 sec 4.1: "...if the server is reading the protocol
             # stream at the beginning of a message and receives a CRLF
@@ -335,8 +733,9 @@ class HTTPRequest(object):
         
         environ = self.environ
         
+        self.request_line = request_line.strip()
         try:
-            method, path, req_protocol = request_line.strip().split(" ", 2)
+            method, path, req_protocol = self.request_line.split(" ", 2)
         except ValueError:
             self.simple_response(400, "Malformed Request-Line")
             return
@@ -455,27 +854,37 @@ class HTTPRequest(object):
         #      expect/continue, and sends the request body on its own.
         #      (This is suboptimal, and is not recommended.)
         #
-        # We used to do 3, but are now doing 1. Maybe we'll do 2 someday,
-        # but it seems like it would be a big slowdown for such a rare case.
-        if environ.get("HTTP_EXPECT", "") == "100-continue":
-            self.simple_response(100)
+        # We used to do 3, then 1, and now do 2 (see ContinueRFile), so
+        # that an app which rejects the request without reading it (a 401,
+        # say, or a 413) spares the client from sending the body at all.
+        if (environ.get("HTTP_EXPECT", "") == "100-continue"
+            and self.response_protocol == "HTTP/1.1"
+            and (self.chunked_read or int(environ.get("CONTENT_LENGTH", 0)))):
+            self.expect_continue = True
         
         self.ready = True
+        if self.hooks is not None:
+            self.hooks.request_parsed(self.conn, self, monotonic())
     
     def read_headers(self):
         """Read header lines from the incoming stream."""
         environ = self.environ
         
-        while True:
-            line = self.rfile.readline()
-            if not line:
-                # No more data--illegal end of headers
+        # Read the whole block in one go and split it, rather than
+        # calling readline for each header.
+        block = self.rfile.readheaderblock()
+        if block == "\r\n":
+            lines = []
+        elif block[-4:] == "\r\n\r\n":
+            lines = block[:-4].split("\n")
+        else:
+            # No more data--illegal end of headers
+            raise ValueError("Illegal end of headers.")
+        
+        for line in lines:
+            if not line.strip():
                 raise ValueError("Illegal end of headers.")
             
-            if line == '\r\n':
-                # Normal end of headers
-                break
-            
             if line[0] in ' \t':
                 # It's a continuation line.
                 v = line.strip()
@@ -497,33 +906,6 @@ class HTTPRequest(object):
         if cl is not None:
             environ["CONTENT_LENGTH"] = cl
     
-    def decode_chunked(self):
-        """Decode the 'chunked' transfer coding."""
-        cl = 0
-        data = StringIO.StringIO()
-        while True:
-            line = self.rfile.readline().strip().split(";", 1)
-            chunk_size = int(line.pop(0), 16)
-            if chunk_size <= 0:
-                break
-##            if line: chunk_extension = line[0]
-            cl += chunk_size
-            data.write(self.rfile.read(chunk_size))
-            crlf = self.rfile.read(2)
-            if crlf != "\r\n":
-                self.simple_response("400 Bad Request",
-                                     "Bad chunked transfer coding "
-                                     "(expected '\\r\\n', got %r)" % crlf)
-                return
-        
-        # Grab any trailer headers
-        self.read_headers()
-        
-        data.seek(0)
-        self.environ["wsgi.input"] = data
-        self.environ["CONTENT_LENGTH"] = str(cl) or ""
-        return True
-    
     def respond(self):
         """Call the appropriate WSGI app and write its iterable output."""
         # Set rfile.maxlen to ensure we don't read past Content-Length.
@@ -546,37 +928,109 @@ class HTTPRequest(object):
             if not self.sent_headers:
                 self.simple_response("413 Request Entity Too Large")
             return
+        except ChunkedBodyError, ex:
+            self.close_connection = True
+            if not self.sent_headers:
+                self.simple_response("400 Bad Request", ex.args[0])
+            return
+        finally:
+            if self.corked:
+                self.uncork()
     
     def _respond(self):
         if self.chunked_read:
-            if not self.decode_chunked():
-                self.close_connection = True
-                return
-        
+            body = ChunkedRFile(self.rfile, self.read_headers)
+            if self.stream_chunked:
+                # The body is decoded as the app reads it, so its length
+                # isn't known: wsgi.input returns '' at the end instead.
+                self.environ["wsgi.input"] = body
+                self.environ["wsgi.input_terminated"] = True
+            else:
+                # Read it all now, so the app gets a CONTENT_LENGTH.
+                self.send_continue()
+                data = body.read()
+                self.environ["CONTENT_LENGTH"] = str(len(data))
+                self.environ["wsgi.input"] = StringIO.StringIO(data)
+        
+        if self.expect_continue:
+            self.environ["wsgi.input"] = ContinueRFile(
+                self.environ["wsgi.input"], self.send_continue)
+        
+        hooks = self.hooks
+        if hooks is not None:
+            hooks.app_called(self.conn, self, monotonic())
         response = self.wsgi_app(self.environ, self.start_response)
+        if hooks is not None:
+            hooks.app_returned(self.conn, self, monotonic())
+        
+        # A list or tuple is already complete, so there's nothing to be
+        # gained by sending it a chunk at a time: queue it all and send
+        # it (with the headers and the last-chunk) in one go. Other
+        # iterables are sent as they are produced, write_buffer_size
+        # bytes at a time.
+        if isinstance(response, (list, tuple)):
+            buffer_size = None
+        else:
+            buffer_size = self.write_buffer_size
         try:
-            for chunk in response:
-                # "The start_response callable must not actually transmit
-                # the response headers. Instead, it must store them for the
-                # server or gateway to transmit only after the first
-                # iteration of the application return value that yields
-                # a NON-EMPTY string, or upon the application's first
-                # invocation of the write() callable." (PEP 333)
-                if chunk:
-                    self.write(chunk)
+            if (isinstance(response, FileWrapper)
+                and response.fileno() is not None):
+                self.write_file(response)
+            else:
+                for chunk in response:
+                    # "The start_response callable must not actually
+                    # transmit the response headers. Instead, it must
+                    # store them for the server or gateway to transmit
+                    # only after the first iteration of the application
+                    # return value that yields a NON-EMPTY string, or upon
+                    # the application's first invocation of the write()
+                    # callable." (PEP 333)
+                    if chunk:
+                        self.write(chunk, False)
+                        if (buffer_size is not None
+                            and self.outbuf_size >= buffer_size):
+                            self.flush()
+                    elif buffer_size:
+                        # An empty chunk asks for what's queued to go now.
+                        self.flush()
+        except:
+            if not self.sent_headers:
+                # Nothing has gone out, so drop what's queued and let an
+                # error response be sent instead.
+                self.discard()
+            else:
+                # Send what the app did produce before we give up.
+                try:
+                    self.flush()
+                except socket.error:
+                    pass
+            raise
         finally:
             if hasattr(response, "close"):
                 response.close()
         
-        if (self.ready and not self.sent_headers):
-            self.sent_headers = True
+        if (self.ready and not self.headers_queued):
+            self.headers_queued = True
             self.send_headers()
         if self.chunked_write:
-            self.wfile.sendall("0\r\n\r\n")
+            self.outbuf.append("0\r\n\r\n")
+        self.flush()
+        if hooks is not None:
+            hooks.response_sent(self.conn, self, monotonic())
+        
+        if self.chunked_read and not self.close_connection:
+            # Read whatever the app didn't, so that the next request on
+            # this connection is read from the right place.
+            try:
+                while body.read(8192):
+                    pass
+            except (ChunkedBodyError, MaxSizeExceeded):
+                self.close_connection = True
     
     def simple_response(self, status, msg=""):
         """Write a simple response back to the client."""
         status = str(status)
+        self.status = status
         buf = ["%s %s\r\n" % (self.environ['ACTUAL_SERVER_PROTOCOL'], status),
                "Content-Length: %s\r\n" % len(msg),
                "Content-Type: text/plain\r\n"]
@@ -606,8 +1060,8 @@ class HTTPRequest(object):
         
         # "if exc_info is provided, and the HTTP headers have already been
         # sent, start_response must raise an error, and should raise the
-        # exc_info tuple."
-        if self.sent_headers:
+        # exc_info tuple." (Queued headers can't be taken back either.)
+        if self.headers_queued:
             try:
                 raise exc_info[0], exc_info[1], exc_info[2]
             finally:
@@ -618,30 +1072,183 @@ class HTTPRequest(object):
         self.outheaders.extend(headers)
         return self.write
     
-    def write(self, chunk):
+    def write(self, chunk, flush=True):
         """WSGI callable to write unbuffered data to the client.
         
         This method is also used internally by start_response (to write
-        data from the iterable returned by the WSGI application).
+        data from the iterable returned by the WSGI application). If
+        'flush' is False, the chunk is only queued in self.outbuf.
         """
         if not self.started_response:
             raise AssertionError("WSGI write called before start_response.")
         
-        if not self.sent_headers:
-            self.sent_headers = True
+        if not self.headers_queued:
+            self.headers_queued = True
             self.send_headers()
         
-        if self.chunked_write and chunk:
-            buf = [hex(len(chunk))[2:], "\r\n", chunk, "\r\n"]
-            self.wfile.sendall("".join(buf))
-        else:
+        if len(chunk) >= self.coalesce_size:
+            # Don't copy a big chunk just to save a call, but do cork the
+            # socket so that what's queued doesn't go as a packet of its own.
+            if self.chunked_write:
+                self.outbuf.append("%x\r\n" % len(chunk))
+            self.cork()
+            self.flush()
             self.wfile.sendall(chunk)
+            if self.chunked_write:
+                self.outbuf.append("\r\n")
+        elif self.chunked_write and chunk:
+            self.outbuf.extend(("%x\r\n" % len(chunk), chunk, "\r\n"))
+            self.outbuf_size += len(chunk)
+        else:
+            self.outbuf.append(chunk)
+            self.outbuf_size += len(chunk)
+        
+        if flush:
+            self.flush()
+    
+    def write_file(self, wrapper):
+        """Write the regular file behind a FileWrapper to the client.
+        
+        The file is sent from its current position, up to the
+        Content-Length if the application gave one (so a seeked file and
+        a matching Content-Length make a range response), else to the
+        end of the file, in which case a Content-Length is added.
+        Plain sockets use sendfile; SSL connections read and write the
+        file a blksize chunk at a time.
+        """
+        if not self.started_response:
+            raise AssertionError("WSGI write called before start_response.")
+        
+        f = wrapper.filelike
+        fd = wrapper.fileno()
+        offset = f.tell()
+        count = max(os.fstat(fd).st_size - offset, 0)
+        
+        for k, v in self.outheaders:
+            if k.lower() == "content-length":
+                if int(v) > count:
+                    # The file is shorter than promised.
+                    self.close_connection = True
+                count = min(count, int(v))
+                break
+        else:
+            if not self.headers_queued:
+                self.outheaders.append(("Content-Length", str(count)))
+        
+        if not self.headers_queued:
+            self.headers_queued = True
+            self.send_headers()
+        
+        if self.environ["REQUEST_METHOD"] == "HEAD" or not count:
+            return
+        
+        if sendfile is None or isinstance(self.wfile, SSL_fileobject):
+            while count:
+                data = f.read(min(count, wrapper.blksize))
+                if not data:
+                    self.close_connection = True
+                    break
+                count -= len(data)
+                self.write(data)
+            return
+        
+        if self.chunked_write:
+            self.outbuf.append("%x\r\n" % count)
+        self.cork()
+        self.flush()
+        if self.sendfile(fd, offset, count) < count:
+            # The file shrank under us; the response is short.
+            self.close_connection = True
+        if self.chunked_write:
+            self.outbuf.append("\r\n")
+    
+    def sendfile(self, fd, offset, count):
+        """Send count bytes of fd (from offset) with sendfile. Return the
+        number of bytes sent, which is less than count only at EOF."""
+        sock = self.wfile._sock
+        out_fd = sock.fileno()
+        timeout = sock.gettimeout()
+        total = 0
+        while total < count:
+            try:
+                sent = sendfile(out_fd, fd, offset + total, count - total)
+            except OSError, e:
+                if e.errno in socket_errors_nonblocking:
+                    # The socket has a timeout, so it is non-blocking
+                    # underneath: wait until it's writable again.
+                    r, w, x = select.select([], [out_fd], [], timeout)
+                    if not w:
+                        raise socket.timeout("timed out")
+                    continue
+                if e.errno in socket_error_eintr:
+                    continue
+                raise socket.error(e.errno, e.strerror)
+            if not sent:
+                break
+            total += sent
+        self.wfile.sent += total
+        return total
+    
+    def flush(self):
+        """Send everything queued in self.outbuf in a single call."""
+        outbuf = self.outbuf
+        if outbuf:
+            self.outbuf = []
+            self.outbuf_size = 0
+            self.sent_headers = self.headers_queued
+            self.wfile.sendall("".join(outbuf))
+    
+    def discard(self):
+        """Drop everything queued in self.outbuf, headers included, so
+        that a different response can be sent."""
+        self.outbuf = []
+        self.outbuf_size = 0
+        self.headers_queued = False
+        self.chunked_write = False
+    
+    def cork(self):
+        """Set TCP_CORK on a plain socket, so the kernel only sends full
+        segments until uncork is called (at the end of the response)."""
+        if (TCP_CORK is None or self.corked
+            or isinstance(self.wfile, SSL_fileobject)):
+            return
+        try:
+            self.wfile._sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 1)
+            self.corked = True
+        except socket.error:
+            pass
+    
+    def uncork(self):
+        """Clear TCP_CORK, sending any partial segment held back."""
+        self.corked = False
+        try:
+            self.wfile._sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 0)
+        except socket.error:
+            pass
+    
+    def send_continue(self):
+        """Send "100 Continue", telling the client to send the body."""
+        if self.expect_continue:
+            self.expect_continue = False
+            if not self.sent_headers:
+                self.wfile.sendall("%s 100 Continue\r\n\r\n" %
+                                   self.environ['ACTUAL_SERVER_PROTOCOL'])
     
     def send_headers(self):
-        """Assert, process, and send the HTTP response message-headers."""
+        """Assert, process, and queue the HTTP response message-headers.
+        
+        The header block is appended to self.outbuf, so that it can be
+        sent along with the start of the body.
+        """
         hkeys = [key.lower() for key, value in self.outheaders]
         status = int(self.status[:3])
         
+        if self.expect_continue:
+            # The app answered without reading the body, which the client
+            # is still holding back: rather than wait for it (to read and
+            # discard it), close the connection after this response.
+            self.close_connection = True
+        
         if status == 413:
             # Request Entity Too Large. Close conn to avoid garbage.
             self.close_connection = True
@@ -688,13 +1295,8 @@ class HTTPRequest(object):
             if size > 0:
                 self.rfile.read(size)
         
-        if "date" not in hkeys:
-            self.outheaders.append(("Date", rfc822.formatdate()))
-        
-        if "server" not in hkeys:
-            self.outheaders.append(("Server", self.environ['SERVER_SOFTWARE']))
-        
-        buf = [self.environ['ACTUAL_SERVER_PROTOCOL'], " ", self.status, "\r\n"]
+        buf = [status_line(self.environ['ACTUAL_SERVER_PROTOCOL'],
+                           self.status)]
         try:
             buf += [k + ": " + v + "\r\n" for k, v in self.outheaders]
         except TypeError:
@@ -704,8 +1306,15 @@ class HTTPRequest(object):
                 raise TypeError("WSGI response header value %r is not a string.")
             else:
                 raise
+        
+        if "date" not in hkeys:
+            buf.append(date_header())
+        
+        if "server" not in hkeys:
+            buf.append(server_header(self.environ['SERVER_SOFTWARE']))
+        
         buf.append("\r\n")
-        self.wfile.sendall("".join(buf))
+        self.outbuf.extend(buf)
 
 
 class NoSSLError(Exception):
@@ -718,328 +1327,193 @@ class FatalSSLAlert(Exception):
     pass
 
 
-if not _fileobject_uses_str_type:
-    class CP_fileobject(socket._fileobject):
-        """Faux file object attached to a socket object."""
-
-        def sendall(self, data):
-            """Sendall for non-blocking sockets."""
-            while data:
-                try:
-                    bytes_sent = self.send(data)
-                    data = data[bytes_sent:]
-                except socket.error, e:
-                    if e.args[0] not in socket_errors_nonblocking:
-                        raise
-
-        def send(self, data):
-            return self._sock.send(data)
-
-        def flush(self):
-            if self._wbuf:
-                buffer = "".join(self._wbuf)
-                self._wbuf = []
-                self.sendall(buffer)
-
-        def recv(self, size):
-            while True:
-                try:
-                    return self._sock.recv(size)
-                except socket.error, e:
-                    if (e.args[0] not in socket_errors_nonblocking
-                        and e.args[0] not in socket_error_eintr):
-                        raise
-
-        def read(self, size=-1):
-            # Use max, disallow tiny reads in a loop as they are very inefficient.
-            # We never leave read() with any leftover data from a new recv() call
-            # in our internal buffer.
-            rbufsize = max(self._rbufsize, self.default_bufsize)
-            # Our use of StringIO rather than lists of string objects returned by
-            # recv() minimizes memory usage and fragmentation that occurs when
-            # rbufsize is large compared to the typical return value of recv().
-            buf = self._rbuf
-            buf.seek(0, 2)  # seek end
-            if size < 0:
-                # Read until EOF
-                self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                while True:
-                    data = self.recv(rbufsize)
-                    if not data:
-                        break
-                    buf.write(data)
-                return buf.getvalue()
-            else:
-                # Read until size bytes or EOF seen, whichever comes first
-                buf_len = buf.tell()
-                if buf_len >= size:
-                    # Already have size bytes in our buffer?  Extract and return.
-                    buf.seek(0)
-                    rv = buf.read(size)
-                    self._rbuf = StringIO.StringIO()
-                    self._rbuf.write(buf.read())
-                    return rv
-
-                self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                while True:
-                    left = size - buf_len
-                    # recv() will malloc the amount of memory given as its
-                    # parameter even though it often returns much less data
-                    # than that.  The returned data string is short lived
-                    # as we copy it into a StringIO and free it.  This avoids
-                    # fragmentation issues on many platforms.
-                    data = self.recv(left)
-                    if not data:
-                        break
-                    n = len(data)
-                    if n == size and not buf_len:
-                        # Shortcut.  Avoid buffer data copies when:
-                        # - We have no data in our buffer.
-                        # AND
-                        # - Our call to recv returned exactly the
-                        #   number of bytes we were asked to read.
-                        return data
-                    if n == left:
-                        buf.write(data)
-                        del data  # explicit free
-                        break
-                    assert n <= left, "recv(%d) returned %d bytes" % (left, n)
-                    buf.write(data)
-                    buf_len += n
-                    del data  # explicit free
-                    #assert buf_len == buf.tell()
-                return buf.getvalue()
-
-        def readline(self, size=-1):
-            buf = self._rbuf
-            buf.seek(0, 2)  # seek end
-            if buf.tell() > 0:
-                # check if we already have it in our buffer
-                buf.seek(0)
-                bline = buf.readline(size)
-                if bline.endswith('\n') or len(bline) == size:
-                    self._rbuf = StringIO.StringIO()
-                    self._rbuf.write(buf.read())
-                    return bline
-                del bline
-            if size < 0:
-                # Read until \n or EOF, whichever comes first
-                if self._rbufsize <= 1:
-                    # Speed up unbuffered case
-                    buf.seek(0)
-                    buffers = [buf.read()]
-                    self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                    data = None
-                    recv = self.recv
-                    while data != "\n":
-                        data = recv(1)
-                        if not data:
-                            break
-                        buffers.append(data)
-                    return "".join(buffers)
-
-                buf.seek(0, 2)  # seek end
-                self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                while True:
-                    data = self.recv(self._rbufsize)
-                    if not data:
-                        break
-                    nl = data.find('\n')
-                    if nl >= 0:
-                        nl += 1
-                        buf.write(data[:nl])
-                        self._rbuf.write(data[nl:])
-                        del data
-                        break
-                    buf.write(data)
-                return buf.getvalue()
-            else:
-                # Read until size bytes or \n or EOF seen, whichever comes first
-                buf.seek(0, 2)  # seek end
-                buf_len = buf.tell()
-                if buf_len >= size:
-                    buf.seek(0)
-                    rv = buf.read(size)
-                    self._rbuf = StringIO.StringIO()
-                    self._rbuf.write(buf.read())
-                    return rv
-                self._rbuf = StringIO.StringIO()  # reset _rbuf.  we consume it via buf.
-                while True:
-                    data = self.recv(self._rbufsize)
-                    if not data:
-                        break
-                    left = size - buf_len
-                    # did we just receive a newline?
-                    nl = data.find('\n', 0, left)
-                    if nl >= 0:
-                        nl += 1
-                        # save the excess data to _rbuf
-                        self._rbuf.write(data[nl:])
-                        if buf_len:
-                            buf.write(data[:nl])
-                            break
-                        else:
-                            # Shortcut.  Avoid data copy through buf when returning
-                            # a substring of our first recv().
-                            return data[:nl]
-                    n = len(data)
-                    if n == size and not buf_len:
-                        # Shortcut.  Avoid data copy through buf when
-                        # returning exactly all of our first recv().
-                        return data
-                    if n >= left:
-                        buf.write(data[:left])
-                        self._rbuf.write(data[left:])
-                        break
-                    buf.write(data)
-                    buf_len += n
-                    #assert buf_len == buf.tell()
-                return buf.getvalue()
-
-else:
-    class CP_fileobject(socket._fileobject):
-        """Faux file object attached to a socket object."""
-
-        def sendall(self, data):
-            """Sendall for non-blocking sockets."""
-            while data:
-                try:
-                    bytes_sent = self.send(data)
-                    data = data[bytes_sent:]
-                except socket.error, e:
-                    if e.args[0] not in socket_errors_nonblocking:
-                        raise
-
-        def send(self, data):
-            return self._sock.send(data)
-
-        def flush(self):
-            if self._wbuf:
-                buffer = "".join(self._wbuf)
-                self._wbuf = []
-                self.sendall(buffer)
-
-        def recv(self, size):
-            while True:
-                try:
-                    return self._sock.recv(size)
-                except socket.error, e:
-                    if (e.args[0] not in socket_errors_nonblocking
-                        and e.args[0] not in socket_error_eintr):
-                        raise
-
-        def read(self, size=-1):
-            if size < 0:
-                # Read until EOF
-                buffers = [self._rbuf]
-                self._rbuf = ""
-                if self._rbufsize <= 1:
-                    recv_size = self.default_bufsize
-                else:
-                    recv_size = self._rbufsize
-
-                while True:
-                    data = self.recv(recv_size)
-                    if not data:
-                        break
-                    buffers.append(data)
-                return "".join(buffers)
-            else:
-                # Read until size bytes or EOF seen, whichever comes first
-                data = self._rbuf
-                buf_len = len(data)
-                if buf_len >= size:
-                    self._rbuf = data[size:]
-                    return data[:size]
-                buffers = []
-                if data:
-                    buffers.append(data)
-                self._rbuf = ""
-                while True:
-                    left = size - buf_len
-                    recv_size = max(self._rbufsize, left)
-                    data = self.recv(recv_size)
-                    if not data:
-                        break
-                    buffers.append(data)
-                    n = len(data)
-                    if n >= left:
-                        self._rbuf = data[left:]
-                        buffers[-1] = data[:left]
-                        break
-                    buf_len += n
-                return "".join(buffers)
-
-        def readline(self, size=-1):
-            data = self._rbuf
-            if size < 0:
-                # Read until \n or EOF, whichever comes first
-                if self._rbufsize <= 1:
-                    # Speed up unbuffered case
-                    assert data == ""
-                    buffers = []
-                    while data != "\n":
-                        data = self.recv(1)
-                        if not data:
-                            break
-                        buffers.append(data)
-                    return "".join(buffers)
-                nl = data.find('\n')
-                if nl >= 0:
-                    nl += 1
-                    self._rbuf = data[nl:]
-                    return data[:nl]
-                buffers = []
-                if data:
-                    buffers.append(data)
-                self._rbuf = ""
-                while True:
-                    data = self.recv(self._rbufsize)
-                    if not data:
-                        break
-                    buffers.append(data)
-                    nl = data.find('\n')
-                    if nl >= 0:
-                        nl += 1
-                        self._rbuf = data[nl:]
-                        buffers[-1] = data[:nl]
-                        break
-                return "".join(buffers)
-            else:
-                # Read until size bytes or \n or EOF seen, whichever comes first
-                nl = data.find('\n', 0, size)
-                if nl >= 0:
-                    nl += 1
-                    self._rbuf = data[nl:]
-                    return data[:nl]
-                buf_len = len(data)
-                if buf_len >= size:
-                    self._rbuf = data[size:]
-                    return data[:size]
-                buffers = []
-                if data:
-                    buffers.append(data)
-                self._rbuf = ""
-                while True:
-                    data = self.recv(self._rbufsize)
-                    if not data:
-                        break
-                    buffers.append(data)
-                    left = size - buf_len
-                    nl = data.find('\n', 0, left)
-                    if nl >= 0:
-                        nl += 1
-                        self._rbuf = data[nl:]
-                        buffers[-1] = data[:nl]
-                        break
-                    n = len(data)
-                    if n >= left:
-                        self._rbuf = data[left:]
-                        buffers[-1] = data[:left]
-                        break
-                    buf_len += n
-                return "".join(buffers)
+class CP_fileobject(socket._fileobject):
+    """Faux file object attached to a socket object.
+    
+    Received data is kept in one bytearray, filled with recv_into. Reads
+    advance a start offset rather than copying the leftover bytes into a
+    new buffer; the buffer is only compacted (or grown) when there is no
+    room left at the end of it.
+    
+    received, sent: the number of bytes received from and sent on the
+        socket through this object.
+    """
     
+    received = 0
+    sent = 0
+    
+    def __init__(self, sock, mode='rb', bufsize=-1, close=False):
+        socket._fileobject.__init__(self, sock, mode, bufsize, close)
+        # Disallow tiny reads in a loop as they are very inefficient.
+        self._rbufsize = max(self._rbufsize, self.default_bufsize)
+        self._rbuf = bytearray()
+        self._rstart = self._rend = 0
+    
+    def sendall(self, data):
+        """Sendall for non-blocking sockets."""
+        while data:
+            try:
+                bytes_sent = self.send(data)
+                data = data[bytes_sent:]
+            except socket.error, e:
+                if e.args[0] not in socket_errors_nonblocking:
+                    raise
+    
+    def send(self, data):
+        sent = self._sock.send(data)
+        self.sent += sent
+        return sent
+    
+    def flush(self):
+        if self._wbuf:
+            buffer = "".join(self._wbuf)
+            self._wbuf = []
+            self.sendall(buffer)
+    
+    def recv(self, size):
+        while True:
+            try:
+                data = self._sock.recv(size)
+                self.received += len(data)
+                return data
+            except socket.error, e:
+                if (e.args[0] not in socket_errors_nonblocking
+                    and e.args[0] not in socket_error_eintr):
+                    raise
+    
+    def recv_into(self, buf, size):
+        while True:
+            try:
+                received = self._sock.recv_into(buf, size)
+                self.received += received
+                return received
+            except socket.error, e:
+                if (e.args[0] not in socket_errors_nonblocking
+                    and e.args[0] not in socket_error_eintr):
+                    raise
+    
+    def buffered(self):
+        """Return the number of bytes received but not yet read."""
+        return self._rend - self._rstart
+    
+    def _fill(self):
+        """Receive more data into the buffer. Return the number of bytes
+        received (0 on EOF)."""
+        buf = self._rbuf
+        size = self._rbufsize
+        if len(buf) - self._rend < size:
+            n = self._rend - self._rstart
+            if len(buf) - n < size:
+                # Not enough room even if compacted: grow.
+                newbuf = bytearray(max(n + size, len(buf) * 2))
+                newbuf[:n] = buf[self._rstart:self._rend]
+                self._rbuf = buf = newbuf
+            elif n:
+                buf[:n] = buf[self._rstart:self._rend]
+            self._rstart, self._rend = 0, n
+        
+        received = self.recv_into(memoryview(buf)[self._rend:], size)
+        self._rend += received
+        return received
+    
+    def _take(self, size):
+        """Return (and consume) the next 'size' bytes of the buffer."""
+        start = self._rstart
+        data = str(buffer(self._rbuf, start, size))
+        if start + size >= self._rend:
+            self._rstart = self._rend = 0
+        else:
+            self._rstart = start + size
+        return data
+    
+    def read(self, size=-1):
+        if size < 0:
+            # Read until EOF
+            buffers = [self._take(self.buffered())]
+            while self._fill():
+                buffers.append(self._take(self.buffered()))
+            return "".join(buffers)
+        
+        # Read until size bytes or EOF seen, whichever comes first
+        buffered = self.buffered()
+        if buffered >= size:
+            return self._take(size)
+        buffers = []
+        left = size
+        while True:
+            if not buffered and left >= self._rbufsize:
+                # Large read: receive straight into a string
+                # rather than going through the buffer.
+                data = self.recv(left)
+                if not data:
+                    break
+                buffers.append(data)
+                left -= len(data)
+                if not left:
+                    break
+                continue
+            if buffered >= left:
+                buffers.append(self._take(left))
+                break
+            if buffered:
+                buffers.append(self._take(buffered))
+                left -= buffered
+            buffered = self._fill()
+            if not buffered:
+                break
+        return "".join(buffers)
+    
+    def readline(self, size=-1):
+        # Read until \n, size bytes or EOF, whichever comes first
+        scanned = 0
+        while True:
+            nl = self._rbuf.find('\n', self._rstart + scanned, self._rend)
+            if nl >= 0:
+                n = nl + 1 - self._rstart
+                break
+            scanned = self.buffered()
+            if 0 <= size <= scanned:
+                n = size
+                break
+            if not self._fill():
+                n = scanned
+                break
+        if size >= 0:
+            n = min(n, size)
+        return self._take(n)
+    
+    def readheaderblock(self, limit=None):
+        """Read up to and including the CRLF which ends a header block.
+        
+        The request line is assumed to have been read already, so an
+        immediate CRLF is an empty block. If 'limit' bytes are read
+        without finding the end, MaxSizeExceeded is raised. On EOF,
+        whatever was read is returned.
+        """
+        scanned = 0
+        while True:
+            start = self._rstart
+            # Only what is buffered: past _rend are old bytes, left over
+            # from before the buffer was emptied.
+            if (start + 2 <= self._rend
+                and self._rbuf[start:start + 2] == "\r\n"):
+                n = 2
+                break
+            end = self._rbuf.find("\r\n\r\n", start + max(scanned - 3, 0),
+                                  self._rend)
+            if end >= 0:
+                n = end + 4 - start
+                break
+            scanned = self.buffered()
+            if limit is not None and scanned > limit:
+                raise MaxSizeExceeded()
+            if not self._fill():
+                n = scanned
+                break
+        if limit is not None and n > limit:
+            raise MaxSizeExceeded()
+        return self._take(n)
+
 
 class SSL_fileobject(CP_fileobject):
     """SSL file object attached to a socket object."""
@@ -1103,6 +1577,14 @@ class SSL_fileobject(CP_fileobject):
             if not p:
                 return "".join(buf)
     
+    def recv_into(self, buf, size):
+        # pyOpenSSL connections can't receive into a buffer,
+        # so receive a string and copy it in.
+        data = self._safe_call(True, self._sock.recv, size)
+        buf[:len(data)] = data
+        self.received += len(data)
+        return len(data)
+    
     def sendall(self, *args, **kwargs):
         return self._safe_call(False, super(SSL_fileobject, self).sendall, *args, **kwargs)
 
@@ -1116,12 +1598,36 @@ class HTTPConnection(object):
     socket: the raw socket object (usually TCP) for this connection.
     wsgi_app: the WSGI application for this server/connection.
     environ: a WSGI environ template. This will be copied for each request.
+        It belongs to this connection, so is not copied here (the server
+        makes one per connection from its template; see build_environ).
     
     rfile: a fileobject for reading from the socket.
     send: a function for writing (+ flush) to the socket.
+    parkable: if True, communicate() returns True (rather than blocking
+        on the next request) once the connection is idle between
+        requests, so it can be handed to the server's KeepAlivePoller.
+    request_count: the number of requests read from this connection.
+    req: the HTTPRequest being read or answered, while a WorkerThread
+        has the connection.
+    write_buffer_size, stream_chunked: passed on to each HTTPRequest.
+    metrics: if not None, told about each request (see
+        CherryPyWSGIServer.metrics).
+    access_log: if not None, told about each request (see
+        CherryPyWSGIServer.access_log).
+    hooks: if not None, the ServerHooks to call (see
+        CherryPyWSGIServer.hooks).
     """
     
     rbufsize = -1
+    write_buffer_size = 0
+    stream_chunked = False
+    metrics = None
+    access_log = None
+    hooks = None
+    parkable = False
+    enqueued = None
+    request_count = 0
+    req = None
     RequestHandlerClass = HTTPRequest
     environ = {"wsgi.version": (1, 0),
                "wsgi.url_scheme": "http",
@@ -1129,15 +1635,16 @@ class HTTPConnection(object):
                "wsgi.multiprocess": False,
                "wsgi.run_once": False,
                "wsgi.errors": sys.stderr,
+               "wsgi.file_wrapper": FileWrapper,
                }
     
     def __init__(self, sock, wsgi_app, environ):
         self.socket = sock
         self.wsgi_app = wsgi_app
         
-        # Copy the class environ into self.
-        self.environ = self.environ.copy()
-        self.environ.update(environ)
+        # The server builds each connection's environ from its template
+        # (which includes the class environ), so use it as it is.
+        self.environ = environ
         
         if SSL and isinstance(sock, SSL.ConnectionType):
             timeout = sock.gettimeout()
@@ -1156,7 +1663,15 @@ class HTTPConnection(object):
         self.environ["wsgi.input"] = SizeCheckWrapper(self.rfile, 0)
     
     def communicate(self):
-        """Read each request and respond appropriately."""
+        """Read each request and respond appropriately.
+        
+        Returns True if the connection is idle and should be parked
+        (see 'parkable'); otherwise it should be closed.
+        """
+        measured = self.metrics is not None or self.access_log is not None
+        hooks = self.hooks
+        req = measured_req = None
+        received = sent = 0
         try:
             while True:
                 # (re)set req to None so that if something goes wrong in
@@ -1165,15 +1680,32 @@ class HTTPConnection(object):
                 req = None
                 req = self.RequestHandlerClass(self.wfile, self.environ,
                                                self.wsgi_app)
+                self.req = req
+                req.write_buffer_size = self.write_buffer_size
+                req.stream_chunked = self.stream_chunked
+                if hooks is not None:
+                    req.conn = self
+                    req.hooks = hooks
+                if measured:
+                    received, sent = self.rfile.received, self.wfile.sent
                 
                 # This order of operations should guarantee correct pipelining.
                 req.parse_request()
                 if not req.ready:
                     return
                 
+                self.request_count += 1
                 req.respond()
+                if measured:
+                    measured_req = req
+                    self.measure(req, received, sent)
                 if req.close_connection:
                     return
+                
+                if self.parkable and not self.rfile.buffered():
+                    # Nothing pipelined: wait for the next request in the
+                    # poller rather than blocking this worker thread.
+                    return True
         
         except socket.error, e:
             errnum = e.args[0]
@@ -1201,6 +1733,24 @@ class HTTPConnection(object):
         except Exception, e:
             if req and not req.sent_headers:
                 req.simple_response("500 Internal Server Error", format_exc())
+        finally:
+            # Also the requests answered with an error (or cut short) above,
+            # and those parse_request turned away.
+            if (measured and req is not None and req is not measured_req
+                and req.status):
+                self.measure(req, received, sent)
+    
+    def measure(self, req, received, sent):
+        """Tell self.metrics and self.access_log about a request which
+        has been answered."""
+        if req.started is not None:
+            seconds = time.time() - req.started
+            sent = self.wfile.sent - sent
+            if self.metrics is not None:
+                self.metrics.request(req, seconds,
+                                     self.rfile.received - received, sent)
+            if self.access_log is not None:
+                self.access_log.request(req, seconds, sent)
     
     linger = False
     
@@ -1267,10 +1817,18 @@ class WorkerThread(threading.Thread):
                     return
                 
                 self.conn = conn
+                park = False
                 try:
-                    conn.communicate()
+                    park = conn.communicate()
                 finally:
-                    conn.close()
+                    conn.req = None
+                    # stop() sets the poller to None, and a stopped poller
+                    # closes what it's given.
+                    poller = self.server.poller
+                    if park and poller is not None:
+                        poller.park(conn)
+                    else:
+                        conn.close()
                     self.conn = None
         except (KeyboardInterrupt, SystemExit), exc:
             self.server.interrupt = exc
@@ -1281,15 +1839,31 @@ class ThreadPool(object):
     
     ThreadPool objects must provide min, get(), put(obj), start()
     and stop(timeout) attributes.
+    
+    Admission control (see full()):
+    
+    queue_limit: if non-zero, the server turns new connections away
+        while this many are already waiting on the Queue.
+    queue_target: if non-zero, the time (in seconds) a connection may
+        wait on the Queue. In the manner of CoDel, once every connection
+        taken off the Queue for 'queue_interval' seconds has waited longer
+        than this, the pool is 'overloaded' and the server turns new
+        connections away until a connection waits less than the target
+        again (or the Queue empties).
     """
     
+    queue_limit = 0
+    queue_target = 0
+    queue_interval = 1
+    
     def __init__(self, server, min=10, max=-1):
         self.server = server
         self.min = min
         self.max = max
         self._threads = []
         self._queue = Queue.Queue()
-        self.get = self._queue.get
+        self.overloaded = False
+        self._above_target_since = None
     
     def start(self):
         """Start the pool of threads."""
@@ -1304,16 +1878,71 @@ class ThreadPool(object):
     
     def _get_idle(self):
         """Number of worker threads which are idle. Read-only."""
-        return len([t for t in self._threads if t.conn is None])
+        return len([t for t in self._threads
+                    if t.conn is None and t.isAlive()])
     idle = property(_get_idle, doc=_get_idle.__doc__)
     
+    def _get_size(self):
+        """Number of live worker threads. Read-only."""
+        return len([t for t in self._threads if t.isAlive()])
+    size = property(_get_size, doc=_get_size.__doc__)
+    
+    def _get_qsize(self):
+        """Number of connections waiting for a worker thread. Read-only."""
+        return self._queue.qsize()
+    qsize = property(_get_qsize, doc=_get_qsize.__doc__)
+    
     def put(self, obj):
+        if obj is not _SHUTDOWNREQUEST:
+            obj.enqueued = time.time()
+            hooks = self.server.hooks
+            if hooks is not None:
+                hooks.enqueued(obj, monotonic())
         self._queue.put(obj)
+    
+    def get(self):
+        obj = self._queue.get()
         if obj is _SHUTDOWNREQUEST:
-            return
+            return obj
+        hooks = self.server.hooks
+        if hooks is not None:
+            hooks.dequeued(obj, monotonic())
+        metrics = self.server.metrics
+        if metrics is not None:
+            metrics.waited(time.time() - obj.enqueued)
+        if self.queue_target:
+            now = time.time()
+            if now - obj.enqueued < self.queue_target:
+                self._above_target_since = None
+                self.overloaded = False
+            elif self._above_target_since is None:
+                self._above_target_since = now
+            elif now - self._above_target_since >= self.queue_interval:
+                self.overloaded = True
+        return obj
+    
+    def full(self):
+        """Return True if new connections should be turned away."""
+        if self.queue_limit and self._queue.qsize() >= self.queue_limit:
+            return True
+        if self.overloaded:
+            if self._queue.qsize():
+                return True
+            # We've shed enough for the workers to catch up.
+            self.overloaded = False
+            self._above_target_since = None
+        return False
+    
+    def _cull(self):
+        """Remove dead threads from our list. Return how many there were."""
+        dead = [t for t in self._threads if not t.isAlive()]
+        for t in dead:
+            self._threads.remove(t)
+        return len(dead)
     
     def grow(self, amount):
         """Spawn new worker threads (not above self.max)."""
+        self._cull()
         for i in xrange(amount):
             if self.max > 0 and len(self._threads) >= self.max:
                 break
@@ -1325,18 +1954,16 @@ class ThreadPool(object):
     def shrink(self, amount):
         """Kill off worker threads (not below self.min)."""
         # Grow/shrink the pool if necessary.
-        # Remove any dead threads from our list
-        for t in self._threads:
-            if not t.isAlive():
-                self._threads.remove(t)
-                amount -= 1
+        # Remove any dead threads from our list (they were retired by an
+        # earlier shrink, so they don't count towards this one).
+        self._cull()
         
         if amount > 0:
             for i in xrange(min(amount, len(self._threads) - self.min)):
                 # Put a number of shutdown requests on the queue equal
                 # to 'amount'. Once each of those is processed by a worker,
                 # that worker will terminate and be culled from our list
-                # in self.put.
+                # by the next grow() or shrink().
                 self._queue.put(_SHUTDOWNREQUEST)
     
     def stop(self, timeout=5):
@@ -1374,6 +2001,249 @@ class ThreadPool(object):
 
 
 
+class ThreadPoolScaler(threading.Thread):
+    """Grows and shrinks the server's ThreadPool to follow the load.
+    
+    Every 'interval' seconds the pool is grown (up to its max) if
+    connections are waiting on the Queue or no worker thread is idle.
+    Once threads have been idle for 'idle_timeout' seconds, half of the
+    idle ones are retired (down to the pool's min). Decisions are written
+    to server.error_log.
+    """
+    
+    interval = 1
+    idle_timeout = 30
+    
+    def __init__(self, server):
+        threading.Thread.__init__(self)
+        self.setName("CP WSGIServer ThreadPoolScaler")
+        self.setDaemon(True)
+        self.server = server
+        self.pool = server.requests
+        self.ready = False
+        self._quiet = 0
+        self._stop_event = threading.Event()
+    
+    def run(self):
+        self.ready = True
+        while self.ready:
+            self._stop_event.wait(self.interval)
+            if self.ready:
+                self.tick()
+    
+    def tick(self):
+        """Check the pool once, and grow or shrink it if necessary."""
+        pool = self.pool
+        backlog = pool.qsize
+        idle = pool.idle
+        size = pool.size
+        
+        if backlog or not idle:
+            self._quiet = 0
+            if pool.max > 0 and size >= pool.max:
+                return
+            
+            amount = max(backlog, 1)
+            if pool.max > 0:
+                amount = min(amount, pool.max - size)
+            pool.grow(amount)
+            self.server.error_log("Thread pool grown by %d to %d threads "
+                                  "(%d queued, %d idle)"
+                                  % (amount, pool.size, backlog, idle))
+        elif idle > 1 and size > pool.min:
+            self._quiet += self.interval
+            if self._quiet >= self.idle_timeout:
+                self._quiet = 0
+                amount = min(idle // 2, size - pool.min)
+                pool.shrink(amount)
+                self.server.error_log("Thread pool shrunk by %d from %d "
+                                      "threads (%d idle)"
+                                      % (amount, size, idle))
+        else:
+            self._quiet = 0
+    
+    def stop(self):
+        """Stop the scaler thread (leaving the pool as it is)."""
+        self.ready = False
+        self._stop_event.set()
+        if self.isAlive() and self is not threading.currentThread():
+            self.join()
+
+
+class KeepAlivePoller(threading.Thread):
+    """Watches idle connections for their next request.
+    
+    Between requests, a parkable HTTPConnection is handed to park() instead
+    of holding a WorkerThread in a blocking readline(). So is a newly
+    accepted connection whose client hasn't sent anything yet. This thread
+    waits on all parked sockets at once (with epoll, or poll where epoll
+    is not available) and puts each connection back on the server's Queue
+    as soon as its next request starts to arrive. Connections idle for
+    longer than 'timeout' seconds are closed.
+    
+    When the poller is stopped, parked connections are closed, except new
+    ones whose request has already started to arrive: those are put on the
+    Queue, so that a draining server still answers them.
+    """
+    
+    def __init__(self, server, timeout):
+        threading.Thread.__init__(self)
+        self.setName("CP WSGIServer KeepAlivePoller")
+        self.setDaemon(True)
+        self.server = server
+        self.timeout = timeout
+        self.ready = False
+        
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._readmask = select.EPOLLIN | select.EPOLLPRI
+            self._errmask = select.EPOLLERR | select.EPOLLHUP
+        else:
+            self._poller = select.poll()
+            self._readmask = select.POLLIN | select.POLLPRI
+            self._errmask = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        
+        # Connections are registered by this thread only. Worker threads
+        # append to _pending and write a byte to the pipe to wake us.
+        self._pending = collections.deque()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._poller.register(self._wake_r, self._readmask)
+        
+        # fd -> (deadline, fd, conn), and the same entries in the order they
+        # were parked, which (with a single timeout) is also the order they
+        # expire in. A connection parked again gets a new entry, so an old
+        # one left in _deadlines is recognised by not being in _conns.
+        self._conns = {}
+        self._deadlines = collections.deque()
+    
+    def _get_parked(self):
+        """Number of connections currently parked. Read-only."""
+        return len(self._conns) + len(self._pending)
+    parked = property(_get_parked, doc=_get_parked.__doc__)
+    
+    def park(self, conn):
+        """Watch the given (idle) connection for its next request."""
+        if not self.ready:
+            conn.close()
+            return
+        self._pending.append(conn)
+        try:
+            os.write(self._wake_w, "x")
+        except OSError:
+            # The pipe is full, so we've been woken already.
+            pass
+    
+    def run(self):
+        self.ready = True
+        try:
+            while self.ready:
+                self.tick()
+        finally:
+            self._close_all()
+    
+    def tick(self):
+        """Register new connections, dispatch ready ones, expire idle ones."""
+        while self._pending:
+            conn = self._pending.popleft()
+            try:
+                fd = conn.socket.fileno()
+                self._poller.register(fd, self._readmask)
+            except (socket.error, IOError, ValueError):
+                conn.close()
+                continue
+            entry = (time.time() + self.timeout, fd, conn)
+            self._conns[fd] = entry
+            self._deadlines.append(entry)
+        
+        if self._deadlines:
+            wait = max(0, min(1, self._deadlines[0][0] - time.time()))
+        else:
+            wait = 1
+        
+        try:
+            if hasattr(select, "epoll"):
+                events = self._poller.poll(wait)
+            else:
+                events = self._poller.poll(wait * 1000)
+        except (select.error, IOError), e:
+            if e.args[0] in socket_error_eintr:
+                return
+            raise
+        
+        for fd, event in events:
+            if fd == self._wake_r:
+                try:
+                    while os.read(self._wake_r, 4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+            
+            entry = self._conns.pop(fd, None)
+            if entry is None:
+                continue
+            conn = entry[2]
+            self._poller.unregister(fd)
+            
+            if event & self._readmask:
+                # The next request is arriving (or the client closed, which
+                # the worker will notice when it reads nothing).
+                self.server.requests.put(conn)
+            else:
+                conn.close()
+        
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            entry = self._deadlines.popleft()
+            deadline, fd, conn = entry
+            if self._conns.get(fd) is entry:
+                del self._conns[fd]
+                self._poller.unregister(fd)
+                conn.close()
+    
+    def _close_all(self):
+        conns = list(self._pending)
+        self._pending.clear()
+        for deadline, fd, conn in self._conns.values():
+            try:
+                self._poller.unregister(fd)
+            except (IOError, ValueError, KeyError):
+                pass
+            conns.append(conn)
+        self._conns.clear()
+        self._deadlines.clear()
+        
+        for conn in conns:
+            if (not conn.request_count
+                and self.server._readable(conn.socket)):
+                self.server.requests.put(conn)
+            else:
+                conn.close()
+    
+    def stop(self, timeout=5):
+        """Close all parked connections and stop the poller thread."""
+        self.ready = False
+        try:
+            os.write(self._wake_w, "x")
+        except OSError:
+            pass
+        if self.isAlive() and self is not threading.currentThread():
+            self.join(timeout)
+        self._close_all()
+        for fd in (self._wake_r, self._wake_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if hasattr(self._poller, "close"):
+            # poll objects have no close(); epoll objects hold an fd.
+            self._poller.close()
+
+
 class SSLConnection:
     """A thread-safe wrapper for an SSL.Connection.
     
@@ -1438,9 +2308,11 @@ class CherryPyWSGIServer(object):
     wsgi_app: the WSGI 'application callable'; multiple WSGI applications
         may be passed as (path_prefix, app) pairs.
     numthreads: the number of worker threads to create (default 10).
+    max: the maximum number of worker threads (defaults to -1 = no limit).
+        If greater than numthreads, a ThreadPoolScaler grows the pool
+        under load and shrinks it back towards numthreads when idle.
     server_name: the string to set for WSGI's SERVER_NAME environ entry.
         Defaults to socket.gethostname().
-    max: the maximum number of queued requests (defaults to -1 = no limit).
     request_queue_size: the 'backlog' argument to socket.listen();
         specifies the maximum number of queued connections (default 5).
     timeout: the timeout in seconds for accepted connections (default 10).
@@ -1448,6 +2320,45 @@ class CherryPyWSGIServer(object):
     nodelay: if True (the default since 3.1), sets the TCP_NODELAY socket
         option.
     
+    retry_after: the Retry-After value (in seconds) of the 503 response
+        sent to connections which are turned away because the ThreadPool
+        is full (see ThreadPool.queue_limit and queue_target).
+    
+    write_buffer_size: if non-zero, output yielded by streaming responses
+        is sent this many bytes at a time, rather than a send per chunk
+        (see HTTPRequest.write_buffer_size).
+    
+    stream_chunked: if True, chunked request bodies are decoded as the
+        app reads them, rather than read in full before it is called
+        (see HTTPRequest.stream_chunked).
+    
+    park_idle: if True, idle connections (new ones which haven't sent
+        their request yet, and keep-alive ones between requests) are
+        handed to a KeepAlivePoller, instead of each one holding a worker
+        thread until its next request (or the timeout). Not used for SSL
+        connections, or where neither epoll nor poll exists.
+    
+    reuse_port: if True, sets the SO_REUSEPORT socket option so that
+        several processes can each bind their own listening socket to
+        the same address, and the kernel spreads new connections across
+        them (rather than all processes waking on one shared socket).
+    
+    metrics: if not None, an object which is told about the server's
+        work as it happens: accepted() and rejected() for each new
+        connection taken or turned away, waited(seconds) each time a
+        connection is taken off the Queue, and request(req, seconds,
+        received, sent) for each request answered (with the time from
+        its request line arriving and the bytes read and written).
+        The calls are made on the thread doing the work, so they must
+        be cheap.
+    
+    access_log: if not None, an object whose request(req, seconds, sent)
+        is called for each request answered, in the same way as for
+        metrics (sent counts the bytes of the headers too).
+    
+    hooks: if not None, a ServerHooks instance, called as each connection
+        and request moves from one phase to the next.
+    
     protocol: the version string to write in the Status-Line of all
         HTTP responses. For example, "HTTP/1.1" (the default). This
         also limits the supported features used in the response.
@@ -1470,9 +2381,20 @@ class CherryPyWSGIServer(object):
     _bind_addr = "127.0.0.1"
     version = "CherryPy/3.1.2"
     ready = False
+    draining = False
     _interrupt = None
     
     nodelay = True
+    reuse_port = False
+    park_idle = False
+    poller = None
+    scaler = None
+    retry_after = 5
+    write_buffer_size = 0
+    stream_chunked = False
+    metrics = None
+    access_log = None
+    hooks = None
     
     ConnectionClass = HTTPConnection
     environ = {}
@@ -1554,8 +2476,16 @@ class CherryPyWSGIServer(object):
         # because cherrpy.server already does so, calling self.stop() for us.
         # If you're using this server with another framework, you should
         # trap those exceptions in whatever code block calls start().
-        self._interrupt = None
+        self.prepare()
+        self.serve()
+    
+    def prepare(self):
+        """Create, bind and listen on the socket (but don't accept yet).
         
+        Splitting this out of start() allows the listening socket to be
+        created once and then shared by several forked processes, each
+        of which calls serve().
+        """
         # Select the appropriate socket
         if isinstance(self.bind_addr, basestring):
             # AF_UNIX socket
@@ -1598,12 +2528,35 @@ class CherryPyWSGIServer(object):
         # Timeout so KeyboardInterrupt can be caught on Win32
         self.socket.settimeout(1)
         self.socket.listen(self.request_queue_size)
+    
+    def serve(self):
+        """Start the worker threads and accept connections until stopped."""
+        self._interrupt = None
         
         # Create worker threads
         self.requests.start()
         
+        if self.park_idle and (hasattr(select, "epoll")
+                               or hasattr(select, "poll")):
+            self.poller = KeepAlivePoller(self, self.timeout)
+            self.poller.start()
+        
+        if self.requests.max > self.requests.min:
+            self.scaler = ThreadPoolScaler(self)
+            self.scaler.start()
+        
+        self._environ = self.build_environ()
+        
+        # Built once, so turning a connection away costs next to nothing.
+        self._overload_response = (
+            "%s 503 Service Unavailable\r\n"
+            "Content-Length: 0\r\n"
+            "Retry-After: %d\r\n"
+            "Connection: close\r\n\r\n" % (self.protocol, self.retry_after))
+        
         self.ready = True
-        while self.ready:
+        self.draining = False
+        while self.ready and not self.draining:
             self.tick()
             if self.interrupt:
                 while self.interrupt is True:
@@ -1611,24 +2564,36 @@ class CherryPyWSGIServer(object):
                     time.sleep(0.1)
                 if self.interrupt:
                     raise self.interrupt
+        
+        if self.draining:
+            # Connections already on the Queue are handled before the
+            # shutdown requests which stop() puts behind them.
+            self.stop()
+    
+    def drain(self):
+        """Stop accepting after the current tick and let serve() return.
+        
+        Unlike stop(), this is safe to call from a signal handler which
+        interrupts tick(): a connection which has just been accepted is
+        still queued, and every queued connection is served before the
+        worker threads exit.
+        """
+        self.draining = True
     
     def bind(self, family, type, proto=0):
         """Create (or recreate) the actual socket object."""
         self.socket = socket.socket(family, type, proto)
         prevent_socket_inheritance(self.socket)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            if SO_REUSEPORT is None:
+                raise socket.error("SO_REUSEPORT is not supported on "
+                                   "this platform.")
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         if self.nodelay:
             self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         if self.ssl_certificate and self.ssl_private_key:
-            if SSL is None:
-                raise ImportError("You must install pyOpenSSL to use HTTPS.")
-            
-            # See http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/442473
-            ctx = SSL.Context(SSL.SSLv23_METHOD)
-            ctx.use_privatekey_file(self.ssl_private_key)
-            ctx.use_certificate_file(self.ssl_certificate)
-            self.socket = SSLConnection(ctx, self.socket)
-            self.populate_ssl_environ()
+            self.wrap_ssl()
             
             # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
             # activate dual-stack. See http://www.cherrypy.org/ticket/871.
@@ -1643,6 +2608,35 @@ class CherryPyWSGIServer(object):
         
         self.socket.bind(self.bind_addr)
     
+    def wrap_ssl(self):
+        """Wrap self.socket in an SSL connection using our certificate."""
+        if SSL is None:
+            raise ImportError("You must install pyOpenSSL to use HTTPS.")
+        
+        # See http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/442473
+        ctx = SSL.Context(SSL.SSLv23_METHOD)
+        ctx.use_privatekey_file(self.ssl_private_key)
+        ctx.use_certificate_file(self.ssl_certificate)
+        self.socket = SSLConnection(ctx, self.socket)
+        self.populate_ssl_environ()
+    
+    def inherit_socket(self, fd, family):
+        """Use an already bound and listening socket instead of prepare().
+        
+        fd: the file descriptor of the listening socket, typically
+            inherited across exec() from the server being replaced.
+        family: the address family of that socket.
+        """
+        # fromfd() returns a bare _socket.socket (and dups the descriptor,
+        # so we don't need the original).
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        self.socket = socket.socket(family, socket.SOCK_STREAM, _sock=sock)
+        os.close(fd)
+        prevent_socket_inheritance(self.socket)
+        if self.ssl_certificate and self.ssl_private_key:
+            self.wrap_ssl()
+        self.socket.settimeout(1)
+    
     def tick(self):
         """Accept a new connection and put it on the Queue."""
         try:
@@ -1650,32 +2644,42 @@ class CherryPyWSGIServer(object):
             prevent_socket_inheritance(s)
             if not self.ready:
                 return
+            if self.requests.full():
+                if self.metrics is not None:
+                    self.metrics.rejected()
+                self.reject(s)
+                return
+            if self.metrics is not None:
+                self.metrics.accepted()
             if hasattr(s, 'settimeout'):
                 s.settimeout(self.timeout)
             
-            environ = self.environ.copy()
-            # SERVER_SOFTWARE is common for IIS. It's also helpful for
-            # us to pass a default value for the "Server" response header.
-            if environ.get("SERVER_SOFTWARE") is None:
-                environ["SERVER_SOFTWARE"] = "%s WSGI Server" % self.version
-            # set a non-standard environ entry so the WSGI app can know what
-            # the *real* server protocol is (and what features to support).
-            # See http://www.faqs.org/rfcs/rfc2145.html.
-            environ["ACTUAL_SERVER_PROTOCOL"] = self.protocol
-            environ["SERVER_NAME"] = self.server_name
-            
-            if isinstance(self.bind_addr, basestring):
-                # AF_UNIX. This isn't really allowed by WSGI, which doesn't
-                # address unix domain sockets. But it's better than nothing.
-                environ["SERVER_PORT"] = ""
-            else:
-                environ["SERVER_PORT"] = str(self.bind_addr[1])
+            environ = self._environ.copy()
+            if not isinstance(self.bind_addr, basestring):
                 # optional values
                 # Until we do DNS lookups, omit REMOTE_HOST
                 environ["REMOTE_ADDR"] = addr[0]
                 environ["REMOTE_PORT"] = str(addr[1])
             
             conn = self.ConnectionClass(s, self.wsgi_app, environ)
+            conn.write_buffer_size = self.write_buffer_size
+            conn.stream_chunked = self.stream_chunked
+            conn.metrics = self.metrics
+            conn.access_log = self.access_log
+            if self.hooks is not None:
+                conn.hooks = self.hooks
+                self.hooks.accepted(conn, monotonic())
+            if self.poller is not None and not (
+                    SSL and isinstance(s, SSL.ConnectionType)):
+                # Data may be waiting inside the SSL layer where the poller
+                # can't see it, so only plain sockets are parked.
+                conn.parkable = True
+                if not self._readable(s):
+                    # Don't give a thread to a client that has connected
+                    # but not sent its request yet (e.g. a browser's
+                    # speculative preconnect).
+                    self.poller.park(conn)
+                    return
             self.requests.put(conn)
         except socket.timeout:
             # The only reason for the timeout in start() is so we can
@@ -1699,6 +2703,66 @@ class CherryPyWSGIServer(object):
                 return
             raise
     
+    def build_environ(self):
+        """Return the template that each connection's environ is copied
+        from: the connection class environ, plus self.environ, plus the
+        entries which are the same for every connection to this server."""
+        environ = self.ConnectionClass.environ.copy()
+        environ.update(self.environ)
+        # SERVER_SOFTWARE is common for IIS. It's also helpful for
+        # us to pass a default value for the "Server" response header.
+        if environ.get("SERVER_SOFTWARE") is None:
+            environ["SERVER_SOFTWARE"] = "%s WSGI Server" % self.version
+        # set a non-standard environ entry so the WSGI app can know what
+        # the *real* server protocol is (and what features to support).
+        # See http://www.faqs.org/rfcs/rfc2145.html.
+        environ["ACTUAL_SERVER_PROTOCOL"] = self.protocol
+        environ["SERVER_NAME"] = self.server_name
+        
+        if isinstance(self.bind_addr, basestring):
+            # AF_UNIX. This isn't really allowed by WSGI, which doesn't
+            # address unix domain sockets. But it's better than nothing.
+            environ["SERVER_PORT"] = ""
+        else:
+            environ["SERVER_PORT"] = str(self.bind_addr[1])
+        return environ
+    
+    def _readable(self, sock):
+        """Return True if data has arrived on the given (plain) socket."""
+        timeout = sock.gettimeout()
+        sock.setblocking(0)
+        try:
+            try:
+                return bool(sock.recv(1, socket.MSG_PEEK))
+            except socket.error, x:
+                if x.args[0] in socket_errors_nonblocking:
+                    return False
+                # Let the worker thread deal with (and report) the error.
+                return True
+        finally:
+            sock.settimeout(timeout)
+    
+    def reject(self, sock):
+        """Turn a new connection away with a 503 (we're overloaded)."""
+        try:
+            if not (SSL and isinstance(sock, SSL.ConnectionType)):
+                # Don't wait on the client; if this doesn't fit in the
+                # socket buffer straight away we just close.
+                sock.setblocking(0)
+                sock.send(self._overload_response)
+                try:
+                    # Discard whatever request has already arrived, so
+                    # that close() sends a FIN rather than an RST.
+                    sock.recv(65536)
+                except socket.error:
+                    pass
+                sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        if hasattr(sock, "_sock"):
+            sock._sock.close()
+        sock.close()
+    
     def _get_interrupt(self):
         return self._interrupt
     def _set_interrupt(self, interrupt):
@@ -1745,8 +2809,29 @@ class CherryPyWSGIServer(object):
                 sock.close()
             self.socket = None
         
+        if self.scaler is not None:
+            self.scaler.stop()
+            self.scaler = None
+        
+        if self.poller is not None:
+            # Before the pool, so no parked connection is woken onto the
+            # Queue behind the shutdown requests.
+            self.poller.stop()
+            self.poller = None
+        
         self.requests.stop(self.shutdown_timeout)
     
+    def error_log(self, msg="", level=20, traceback=False):
+        """Write msg (and optionally the current traceback) to the log.
+        
+        level uses the values of the standard logging module. This writes
+        to stderr; override it to send messages somewhere else.
+        """
+        if traceback:
+            msg = msg + "\n" + format_exc()
+        sys.stderr.write(msg + "\n")
+        sys.stderr.flush()
+    
     def populate_ssl_environ(self):
         """Create WSGI environ entries to be merged into each request."""
         cert = open(self.ssl_certificate, 'rb').read()